@@ -0,0 +1,254 @@
+"""
+Micro-benchmark of the autoresponse `on_message` path, in messages per second:
+a handler constructed for every message with its awaited validity check,
+against the shared `AutoResponseHandler.run` with its synchronous checks.
+
+Run from the repository root, with the bot's environment variables set:
+    python -m bench.autoresponse_listener [--triggers 300] [--messages 20000]
+"""
+
+import argparse
+import asyncio
+import random
+import string
+import time
+from types import SimpleNamespace
+from typing import Awaitable, Callable, List
+
+from cachetools import LRUCache
+
+from bot.utils.autoresponse_handler import AutoResponseHandler, GuildAutoResponses
+from bot.utils.model_cache import ModelCache
+
+GUILD_ID = 1
+
+
+class PerMessageAutoResponseHandler:
+    """The handler as it was before being shared, constructed for every message"""
+
+    def __init__(self, bot, message, autoresponse_cache: ModelCache):
+        self._bot = bot
+        self._message = message
+        self._guild_id = message.guild.id
+        self._autoresponse_cache = autoresponse_cache
+
+    @property
+    def autoresponse_models_cache(self):
+        return self._autoresponse_cache
+
+    async def autoresponses(self):
+        return await self.guild_autoresponses(self._guild_id)
+
+    async def filtered_autoresponses(self):
+        return await self.guild_filtered_autoresponses(await self.autoresponses())
+
+    async def message_is_valid(self):
+        message = self._message
+        if (
+            message.author.bot
+            or message.embeds
+            or not message.content
+            or not message.guild
+        ):
+            return False
+        return True
+
+    async def guild_autoresponses(self, guild_id: int) -> GuildAutoResponses:
+        return await self._autoresponse_cache.get_or_load(
+            guild_id, lambda: GuildAutoResponses.from_guild_id(guild_id)
+        )
+
+    async def guild_filtered_autoresponses(self, guild_autoresponses):
+        return guild_autoresponses.matcher.match(self._message.content.split())
+
+    async def _autoresponse_message_formatter(self, message, response: str) -> str:
+        mentioned = message.mentions[0] if "{mentioned" in response else None
+        message_content = (
+            " ".join(message.content.split(" ")[1:])
+            if "{message}" in response
+            else None
+        )
+        return response.format(
+            author=message.author,
+            message=message_content,
+            raw_message=message,
+            server=message.guild,
+            mentioned=mentioned,
+        )
+
+    async def _extra_arguements_handler(self, autoresponse_model):
+        if autoresponse_model.has_variables:
+            output = await self._autoresponse_message_formatter(
+                self._message, autoresponse_model.response
+            )
+        elif autoresponse_model.trigger == self._message.content:
+            output = autoresponse_model.response
+        elif autoresponse_model.extra_arguements:
+            output = autoresponse_model.response
+        else:
+            output = None
+
+        if output:
+            return output
+
+    async def run(self):
+        if not await self.message_is_valid():
+            return
+
+        filtered_autoresponses = await self.filtered_autoresponses()
+        if not filtered_autoresponses:
+            return
+
+        return await self._extra_arguements_handler(filtered_autoresponses)
+
+
+class StubChannel:
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, content: str) -> None:
+        self.sent += 1
+
+
+def random_words(rng: random.Random, count: int) -> str:
+    return " ".join(
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 8)))
+        for _ in range(count)
+    )
+
+
+def make_autoresponses(rng: random.Random, count: int) -> List[SimpleNamespace]:
+    # Stand-ins for AutoResponseModel, only what the handlers read
+    autoresponses = []
+    for _ in range(count):
+        has_variables = rng.random() < 0.2
+        autoresponses.append(
+            SimpleNamespace(
+                trigger=random_words(rng, rng.randint(1, 3)),
+                response="Hi {author.mention}!" if has_variables else "Hi!",
+                enabled=rng.random() > 0.1,
+                extra_arguements=rng.random() < 0.5,
+                has_variables=has_variables,
+            )
+        )
+    return autoresponses
+
+
+def make_messages(
+    rng: random.Random,
+    autoresponses: List[SimpleNamespace],
+    count: int,
+    hits: float,
+    bots: float,
+) -> List[SimpleNamespace]:
+    guild = SimpleNamespace(id=GUILD_ID, name="guild")
+    channel = StubChannel()
+    user = SimpleNamespace(bot=False, mention="<@1>")
+    bot_user = SimpleNamespace(bot=True, mention="<@2>")
+
+    messages = []
+    for _ in range(count):
+        if rng.random() < hits:
+            trigger = rng.choice(autoresponses).trigger
+            content = f"{trigger} {random_words(rng, rng.randint(0, 3))}".strip()
+        else:
+            content = random_words(rng, rng.randint(1, 12))
+
+        messages.append(
+            SimpleNamespace(
+                author=bot_user if rng.random() < bots else user,
+                content=content,
+                embeds=[],
+                guild=guild,
+                channel=channel,
+                mentions=[],
+            )
+        )
+    return messages
+
+
+def per_message_listener(bot, autoresponse_cache: ModelCache):
+    # The cog's `on_message` before the handler was shared
+    async def on_message(msg) -> None:
+        if not msg.guild:
+            return
+
+        autoresponse_handler = PerMessageAutoResponseHandler(
+            bot, msg, autoresponse_cache
+        )
+        output = await autoresponse_handler.run()
+
+        if not output:
+            return
+
+        await msg.channel.send(output)
+
+    return on_message
+
+
+def shared_listener(bot, autoresponse_cache: ModelCache):
+    autoresponse_handler = AutoResponseHandler(bot, autoresponse_cache)
+
+    async def on_message(msg) -> None:
+        await autoresponse_handler.run(msg)
+
+    return on_message
+
+
+async def measure(
+    on_message: Callable[[SimpleNamespace], Awaitable[None]],
+    messages: List[SimpleNamespace],
+    runs: int,
+) -> float:
+    """Best messages per second out of `runs`"""
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        for message in messages:
+            await on_message(message)
+        best = min(best, time.perf_counter() - start)
+    return len(messages) / best
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--triggers", type=int, default=300)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--hits", type=float, default=0.05)
+    parser.add_argument("--bots", type=float, default=0.1)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    autoresponses = make_autoresponses(rng, args.triggers)
+    messages = make_messages(rng, autoresponses, args.messages, args.hits, args.bots)
+
+    # The guild is cached up front, neither path touches the db
+    autoresponse_cache = ModelCache(LRUCache(1000))
+    autoresponse_cache[GUILD_ID] = GuildAutoResponses(autoresponses)
+    bot = SimpleNamespace()
+
+    channel = messages[0].channel
+    results = []
+    for name, listener in (
+        ("per-message handler", per_message_listener),
+        ("shared handler", shared_listener),
+    ):
+        channel.sent = 0
+        rate = await measure(listener(bot, autoresponse_cache), messages, args.runs)
+        results.append((name, rate, channel.sent // args.runs))
+
+    print(
+        f"{args.triggers} triggers, {args.messages} messages, "
+        f"{args.hits:.0%} hits, {args.bots:.0%} from bots"
+    )
+    # Both have to send the same responses before their speed means anything
+    assert len({sent for _, _, sent in results}) == 1, results
+    baseline = results[0][1]
+    for name, rate, sent in results:
+        print(f"{name:<20} {rate:>10,.0f} msg/s ({rate / baseline:.2f}x), {sent} sent")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
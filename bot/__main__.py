@@ -17,6 +17,8 @@ if __name__ == "__main__":
         tortoise_config=tortoise_config,
         prefix=bot_config.prefix,
         developement_environment=bot_config.developement_environment,
+        write_behind_registration=bot_config.write_behind_registration,
+        max_messages=bot_config.max_messages,
         log_webhook_url=misc_settings.log_webhook_url,
     )
 
@@ -2,7 +2,7 @@ import logging
 import os
 import traceback
 from itertools import cycle
-from typing import List
+from typing import TYPE_CHECKING, Awaitable, Callable, Iterable, List, Optional
 
 import discord
 import watchgod
@@ -13,9 +13,16 @@ from discord.ext import commands, tasks
 from tortoise import Tortoise
 
 from bot.help_command import HelpCommand
+from bot.utils.command_index import CommandIndex
 from bot.utils.errors import CommandDisabled
+from bot.utils.metrics import LatencyRecorder
+from bot.utils.model_cache import ModelCache
+from bot.utils.registration_queue import RegistrationQueue
 from models import CommandModel, GuildModel, UserModel
 
+if TYPE_CHECKING:
+    from bot.utils.cached_reddit import RedditPostCacher
+
 logging.basicConfig(level=logging.INFO)
 
 
@@ -29,24 +36,43 @@ class PeaceBot(commands.Bot):
         load_extensions: bool = True,
         loadjsk: bool = True,
         developement_environment: bool = True,
+        write_behind_registration: bool = True,
+        max_messages: int = 250,
     ):
+        # Snipes don't need the message cache, only reactions on recent prompts do
         super().__init__(
             command_prefix=self.determine_prefix,
             intents=Intents.all(),
             help_command=HelpCommand(),
             case_insensitive=True,
+            max_messages=max_messages,
         )
         self.tortoise_config = tortoise_config
         self.developement_environment = developement_environment
         self.log_webhook_url = log_webhook_url
         self.connect_db.start()
         self.prefix = prefix
-        self.prefixes_cache = LRUCache(1000)
-        self.commands_cache = LRUCache(1000)
-        self.users_cache = LRUCache(1000)
-        self.guilds_cache = LRUCache(1000)
+        self.prefixes_cache = ModelCache(LRUCache(1000))
+        self.commands_cache = ModelCache(LRUCache(1000))
+        self.users_cache = ModelCache(LRUCache(1000))
+        self.guilds_cache = ModelCache(LRUCache(1000))
         self.add_check(self.check)
 
+        # Registers unseen guilds/users in the background instead of in `on_message`
+        self.write_behind_registration = write_behind_registration
+        self.registration_queue = RegistrationQueue()
+        # Time spent in `on_message` before the message is handed to `process_commands`
+        self.pre_dispatch_latency = LatencyRecorder()
+
+        # Shared by the reddit cogs, so that it survives their reloads.
+        # Created by `get_reddit_cache`, as only those cogs need the reddit config.
+        self.reddit_cache: Optional["RedditPostCacher"] = None
+
+        # Coroutines flushing pending writes and closing clients before shutting down
+        self.shutdown_hooks: List[Callable[[], Awaitable[None]]] = [
+            self.registration_queue.flush,
+        ]
+
         # Makes the cog-help case insensivite
         self._botBase__cogs = commands.core._CaseInsensitiveDict()
 
@@ -98,9 +124,8 @@ class PeaceBot(commands.Bot):
         self.change_status.start()
 
     # Determine the unique prefix for each guild
-    async def cache_guild_prefix(self, message: Message) -> None:
-        guild_model = await GuildModel.from_guild_object(message.guild)
-        self.prefixes_cache[message.guild.id] = guild_model.prefix
+    async def fetch_guild_prefix(self, guild_id: int) -> str:
+        guild_model = await self.get_guild_model(guild_id)
         return guild_model.prefix
 
     async def determine_prefix(self, bot: commands.Bot, message: Message) -> str:
@@ -108,9 +133,9 @@ class PeaceBot(commands.Bot):
         if not guild:
             return commands.when_mentioned_or(self.prefix)(bot, message)
 
-        prefix = self.prefixes_cache.get(guild.id)
-        if not prefix:
-            prefix = await self.cache_guild_prefix(message)
+        prefix = await self.prefixes_cache.get_or_load(
+            guild.id, lambda: self.fetch_guild_prefix(guild.id)
+        )
 
         return commands.when_mentioned_or(prefix)(bot, message)
 
@@ -131,6 +156,8 @@ class PeaceBot(commands.Bot):
         logging.info("Connecting to db")
         await Tortoise.init(self.tortoise_config)
         logging.info("Database connected")
+        await self.registration_queue.create_link_index()
+        self.registration_queue.flush_loop.start()
 
     @tasks.loop(seconds=10)
     async def change_status(self):
@@ -181,8 +208,18 @@ class PeaceBot(commands.Bot):
     # On Message checks
     async def on_message(self, message: Message):
         if message.guild == None:
-            await self.process_commands(message)
+            return await self.process_commands(message)
 
+        with self.pre_dispatch_latency.time():
+            if self.write_behind_registration:
+                self.registration_queue.enqueue(message.guild.id, message.author.id)
+            else:
+                await self.register_message_author(message)
+
+        await self.process_commands(message)
+
+    # Registers the message's guild and author in the db inline
+    async def register_message_author(self, message: Message) -> None:
         user = self.users_cache.get(message.author.id)
         guild = self.guilds_cache.get(message.guild.id)
 
@@ -197,38 +234,50 @@ class PeaceBot(commands.Bot):
             if is_new:
                 await guild.users.add(user)
 
-        await self.process_commands(message)
-
     # Creates a guild model on joining guild
     async def on_guild_join(self, guild: discord.Guild):
         await GuildModel.get_or_create(id=guild.id)
 
     # DB models caching handlers
-    async def get_commands_cache(self, guild_id: int) -> List[CommandModel]:
+    async def get_commands_cache(self, guild_id: int) -> CommandIndex:
+        async def load_commands() -> CommandIndex:
+            return CommandIndex(await CommandModel.filter(guild__id=guild_id))
+
+        return await self.commands_cache.get_or_load(guild_id, load_commands)
+
+    def update_commands_cache(
+        self, guild_id: int, records: Iterable[CommandModel]
+    ) -> None:
         commands_cache = self.commands_cache.get(guild_id)
 
-        if not commands_cache:
-            commands_cache = await CommandModel.filter(guild__id=guild_id)
-            self.commands_cache[guild_id] = commands_cache
+        # Uncached guilds get compiled from the db on their next lookup
+        if commands_cache is None:
+            return
 
-        return commands_cache
+        for record in records:
+            commands_cache.update(record)
 
-    async def get_guild_model(self, guild_id: int):
-        guild_model = self.guilds_cache.get(guild_id)
+    def get_reddit_cache(self) -> "RedditPostCacher":
+        if self.reddit_cache is None:
+            from bot.utils.cached_reddit import RedditPostCacher
 
-        if not guild_model:
-            guild_model, _ = await GuildModel.get_or_create(id=guild_id)
+            self.reddit_cache = RedditPostCacher()
+            self.reddit_cache.refresh_loop.start()
+            self.shutdown_hooks.append(self.reddit_cache.close)
 
-        return guild_model
+        return self.reddit_cache
 
-    async def get_user_model(self, user_id: int):
-        user_model = self.users_cache.get(user_id)
+    async def get_guild_model(self, guild_id: int) -> GuildModel:
+        return await self.guilds_cache.get_or_load(
+            guild_id, lambda: GuildModel.from_id(guild_id)
+        )
 
-        if not user_model:
-            user_model = await UserModel.get(id=user_id)
-            self.users_cache[user_id] = user_model
+    async def get_user_model(self, user_id: int) -> UserModel:
+        async def load_user() -> UserModel:
+            user_model, _ = await UserModel.get_or_create(id=user_id)
+            return user_model
 
-        return user_model
+        return await self.users_cache.get_or_load(user_id, load_user)
 
     # Custom channel check for running commands
     # TODO: Add permission/ role check!
@@ -238,27 +287,10 @@ class PeaceBot(commands.Bot):
 
         commands_cache = await self.get_commands_cache(ctx.guild.id)
 
-        defualt_check = (
-            lambda ctx, command: not command.enabled
-            and ctx.channel.id == command.channel
-        )
-        command_check = (
-            lambda ctx, command: not command.is_cog
-            and ctx.command.name.lower() == command.name.lower()
-        )
-        cog_check = (
-            lambda ctx, cog: cog.is_cog
-            and ctx.cog
-            and cog.name.lower() == ctx.cog.qualified_name.lower()
-        )
-
-        current_command = [
-            command.name
-            for command in commands_cache
-            if defualt_check(ctx, command)
-            and (command_check(ctx, command) or cog_check(ctx, command))
-        ]
-        if current_command:
+        if commands_cache.command_disabled(ctx.channel.id, ctx.command.name) or (
+            ctx.cog
+            and commands_cache.cog_disabled(ctx.channel.id, ctx.cog.qualified_name)
+        ):
             raise CommandDisabled(ctx.command.name, ctx.cog.qualified_name)
         return True
 
@@ -285,6 +317,15 @@ class PeaceBot(commands.Bot):
             return None
         return members[0]
 
+    # Flushes the pending db writes before shutting down
+    async def close(self):
+        for hook in self.shutdown_hooks:
+            try:
+                await hook()
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
+        await super().close()
+
     # On ready methods
     async def on_ready(self):
         logging.info(f"Logged in as {self.user.name}#{self.user.discriminator}")
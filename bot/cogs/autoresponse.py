@@ -1,5 +1,4 @@
 import os
-import pickle
 import re
 import uuid
 from typing import List, Optional, Union
@@ -12,8 +11,20 @@ from discord.ext import commands
 from discord.ext.commands import BucketType
 
 from bot.bot import PeaceBot
-from bot.utils.autoresponse_handler import AutoResponseError, AutoResponseHandler
+from bot.utils.autoresponse_handler import (
+    AutoResponseError,
+    AutoResponseHandler,
+    GuildAutoResponses,
+    ResponseTemplate,
+)
+from bot.utils.autoresponse_transfer import (
+    clone_guild_autoresponses,
+    export_lines,
+    insert_autoresponses,
+    parse_lines,
+)
 from bot.utils.mixins.better_cog import BetterCog
+from bot.utils.model_cache import ModelCache
 from bot.utils.wizard_embed import Prompt, Wizard
 from config.personal_guild import personal_guild
 from models import AutoResponseModel, GuildModel, UserModel
@@ -24,46 +35,34 @@ class AutoResponses(BetterCog):
 
     def __init__(self, bot: PeaceBot):
         self.bot = bot
-        self.autoresponse_cache = TTLCache(maxsize=1000, ttl=600)
+        self.autoresponse_cache = ModelCache(TTLCache(maxsize=1000, ttl=600))
+        self.autoresponse_handler = AutoResponseHandler(bot, self.autoresponse_cache)
         super().__init__(bot)
 
     # Runs before every command invokation
     async def cog_before_invoke(self, ctx: commands.Context) -> None:
-        autoresponses = self.autoresponse_cache.get(ctx.guild.id)
-
-        if not autoresponses:
-            autoresponses = await AutoResponseModel.filter(guild__id=ctx.guild.id)
-            self.autoresponse_cache[ctx.guild.id] = autoresponses
+        guild_autoresponses = await self.autoresponse_cache.get_or_load(
+            ctx.guild.id, lambda: GuildAutoResponses.from_guild_id(ctx.guild.id)
+        )
 
-        ctx.autoresponses = autoresponses
+        # Only for reading, the cache entry may expire or be reloaded while a
+        # command waits, so changes are applied through `cached_autoresponses`
+        ctx.autoresponses = guild_autoresponses
 
-    # Runs after every command invokation
-    async def cog_after_invoke(self, ctx: commands.Context) -> None:
-        if ctx.command == self.autoresponse_list:
-            return
-        cache = (
-            await AutoResponseHandler.update_provided_autoresponse_cache(
-                ctx.guild.id, self.autoresponse_cache
-            )
-        )[1]
-        self.autoresponse_cache = cache
+    def cached_autoresponses(self, guild_id: int) -> Optional[GuildAutoResponses]:
+        """
+        The guild's autoresponses as currently cached, to apply a saved change to.
+        If they aren't cached, any in-flight load is dropped since it may predate
+        the change, and the next lookup reloads them from the db.
+        """
+        autoresponses = self.autoresponse_cache.get(guild_id)
+        if autoresponses is None:
+            self.autoresponse_cache.pop(guild_id)
+        return autoresponses
 
     @commands.Cog.listener()
     async def on_message(self, msg: discord.Message):
-        if not msg.guild:
-            return
-
-        autoresponse_handler = AutoResponseHandler(
-            self.bot, msg, self.autoresponse_cache
-        )
-
-        output = await autoresponse_handler.run()
-        self.autoresponse_cache = autoresponse_handler.autoresponse_models_cache
-
-        if not output:
-            return
-
-        await msg.channel.send(output)
+        await self.autoresponse_handler.run(msg)
 
     @commands.group(aliases=["autoresponses"])
     @commands.guild_only()
@@ -79,20 +78,14 @@ class AutoResponses(BetterCog):
         self, ctx: commands.Context, trigger: str, toggle: bool
     ):
         """Enable/ Disable an autoresponse!"""
-        record = [
-            autoresponse
-            for autoresponse in ctx.autoresponses
-            if autoresponse.trigger == trigger
-        ]
-
-        if not record:
-            raise AutoResponseError("This autoresponse doesnot exist in this guild!")
-
-        # Getting the first value from the record as record is a list
-        record = record[0]
+        record = await self.get_autoresponse(ctx, trigger)
         record.enabled = toggle
         await record.save(update_fields=["enabled"])
 
+        autoresponses = self.cached_autoresponses(ctx.guild.id)
+        if autoresponses is not None:
+            autoresponses.add(record)
+
         toggle_str = "enabled" if toggle else "disabled"
 
         await ctx.reply(f"The autoresponse `{trigger}` has been {toggle_str}")
@@ -108,10 +101,10 @@ class AutoResponses(BetterCog):
         Message Content: `message`
         Server: `server`
         Mentioned Person: `mentioned`
+        Whole Message: `raw_message` (Eg: `raw_message.jump_url`)
 
         *Note: Use `{` `}`for variables. Eg: `Hi {author.mention}`*
         """
-        guild = await GuildModel.from_context(ctx)
         prompts = [
             Prompt("Triggered With", description="What shall be the trigger?"),
             Prompt(
@@ -145,12 +138,17 @@ class AutoResponses(BetterCog):
             ctx.channel
         )
 
-        record, _ = await AutoResponseModel.get_or_create(
-            guild=guild, trigger=trigger.lower()
-        )
+        # Rejects unknown variables before anything is saved
+        if has_variables:
+            ResponseTemplate(response)
 
-        user, _ = await UserModel.get_or_create(id=ctx.author.id)
+        guild = await self.bot.get_guild_model(ctx.guild.id)
+        user = await self.bot.get_user_model(ctx.author.id)
 
+        # From the db, the cached autoresponses may have changed during the wizard
+        record = await AutoResponseModel.get_or_none(
+            guild__id=ctx.guild.id, trigger=trigger.lower()
+        ) or AutoResponseModel(guild=guild, trigger=trigger.lower())
         record.enabled = True
         record.response = response
         record.extra_arguements = extra_arguements
@@ -159,12 +157,15 @@ class AutoResponses(BetterCog):
 
         await record.save()
 
+        autoresponses = self.cached_autoresponses(ctx.guild.id)
+        if autoresponses is not None:
+            autoresponses.add(record)
+
     @autoresponse.command(name="delete_all", aliases=["dall", "remall"])
     @commands.cooldown(1, 500, BucketType.user)
     @commands.has_permissions(administrator=True)
     async def autoresponse_delete_all(self, ctx: commands.Context):
         """Delete all the autoresponses in the guild"""
-        guild = await GuildModel.from_context(ctx)
         prompts = [
             Prompt(
                 "Are you sure?",
@@ -182,7 +183,11 @@ class AutoResponses(BetterCog):
         )
         response = await wizard.run(ctx.channel)
         if response:
-            await AutoResponseModel.filter(guild=guild).delete()
+            await AutoResponseModel.filter(guild__id=ctx.guild.id).delete()
+
+            autoresponses = self.cached_autoresponses(ctx.guild.id)
+            if autoresponses is not None:
+                autoresponses.clear()
         else:
             await ctx.reply("Aborted!")
 
@@ -190,16 +195,7 @@ class AutoResponses(BetterCog):
     @commands.cooldown(1, 10, BucketType.user)
     async def autoresponse_delete(self, ctx: commands.Context, trigger: str):
         """Deletes the autoresponse"""
-        guild = await GuildModel.from_context(ctx)
-
-        autoresponse = [
-            autoresponse
-            for autoresponse in ctx.autoresponses
-            if autoresponse.trigger == trigger
-        ]
-
-        if not autoresponse:
-            raise AutoResponseError("This autoresponse doesnot exist in this guild!")
+        autoresponse = await self.get_autoresponse(ctx, trigger)
 
         prompts = [
             Prompt(
@@ -219,20 +215,20 @@ class AutoResponses(BetterCog):
         )
         response = await wizard.run(ctx.channel)
 
-        await AutoResponseModel.get(guild=guild, trigger=trigger).delete()
+        await autoresponse.delete()
+
+        autoresponses = self.cached_autoresponses(ctx.guild.id)
+        if autoresponses is not None:
+            autoresponses.remove(autoresponse)
 
     async def get_autoresponse(
         self,
         ctx: commands.Context,
         trigger: str,
     ):
-        try:
-            autoresponse = [
-                autoresponse
-                for autoresponse in ctx.autoresponses
-                if autoresponse.trigger == trigger
-            ][0]
-        except IndexError:
+        autoresponse = ctx.autoresponses.get(trigger)
+
+        if not autoresponse:
             raise AutoResponseError("This autoresponse doesnot exist in this guild!")
 
         return autoresponse
@@ -303,7 +299,10 @@ class AutoResponses(BetterCog):
         user, _ = await UserModel.get_or_create(id=ctx.author.id)
 
         new_model = await self.clone_autoresponse(autoresponse, guild, user)
-        ctx.autoresponses.append(new_model)
+
+        autoresponses = self.cached_autoresponses(ctx.guild.id)
+        if autoresponses is not None:
+            autoresponses.add(new_model)
 
         await ctx.invoke(self.autoresponse_info, trigger=autoresponse.trigger)
 
@@ -313,30 +312,38 @@ class AutoResponses(BetterCog):
 
     @autoresponse.command(name="importall")
     async def autoresponse_guild_import_all(self, ctx: commands.Context, guild_id: int):
-        previous_autoresponses = await AutoResponseModel.filter(guild__id=guild_id)
+        # The rows reference both of these
+        await self.bot.get_guild_model(ctx.guild.id)
+        await self.bot.get_user_model(ctx.author.id)
 
-        user, _ = await UserModel.get_or_create(id=ctx.author.id)
-        guild = await GuildModel.from_id(ctx.guild.id)
-        for pv_ar in previous_autoresponses:
-            await self.clone_autoresponse(pv_ar, guild, user)
+        total, inserted = await clone_guild_autoresponses(
+            guild_id, ctx.guild.id, ctx.author.id
+        )
+        if not total:
+            raise AutoResponseError("AutoResponses Not Found!")
+
+        autoresponses = self.cached_autoresponses(ctx.guild.id)
+        if autoresponses is not None:
+            for autoresponse in inserted:
+                autoresponses.add(autoresponse)
 
         discord_guild = self.bot.get_guild(guild_id)
-        if not discord_guild:
-            raise AutoResponseError("AutoResponses Not Found!")
+        guild_name = discord_guild.name if discord_guild else guild_id
         await ctx.reply(
-            f"All the autoresponses from server **{discord_guild.name}** have been imported!"
+            f"Imported **{len(inserted)}** autoresponses from server **{guild_name}**, "
+            f"skipped **{total - len(inserted)}** which already exist here!"
         )
 
     @autoresponse.command(name="exportinfile")
     async def autoresponse_export_in_file(self, ctx: commands.Context):
-        autoresponses = ctx.autoresponses
-        file_path = f"cache/{ctx.guild.id}_autoresponses.pickle"
+        file_path = f"cache/{ctx.guild.id}_autoresponses.jsonl"
 
-        async with aiofiles.open(file_path, mode="wb+") as f:
-            await f.write(pickle.dumps(autoresponses))
+        async with aiofiles.open(file_path, mode="w+") as f:
+            for line in export_lines(ctx.autoresponses):
+                await f.write(line)
 
         await ctx.reply(
-            file=discord.File(file_path, f"{ctx.guild.name}_autoresponses.pickle")
+            file=discord.File(file_path, f"{ctx.guild.name}_autoresponses.jsonl")
         )
         os.remove(file_path)
 
@@ -347,19 +354,29 @@ class AutoResponses(BetterCog):
             return
 
         attachment = ctx.message.attachments[0]
-        main_data = pickle.loads(await attachment.read())
-
-        triggers = [autoresponse.trigger for autoresponse in ctx.autoresponses]
-        autoresponses = filter(lambda x: x.trigger not in triggers, main_data)
-
-        if not autoresponses:
+        try:
+            data = (await attachment.read()).decode("utf-8")
+        except UnicodeDecodeError:
+            raise AutoResponseError("This is not a supported autoresponse export!")
+
+        rows = [
+            row
+            for row in parse_lines(data.splitlines())
+            if not ctx.autoresponses.get(row.trigger)
+        ]
+        if not rows:
             raise AutoResponseError("Every autoresponse here already exists!")
 
-        guild = await GuildModel.from_context(ctx)
-        user, _ = await UserModel.get_or_create(id=ctx.author.id)
+        # The rows reference both of these
+        await self.bot.get_guild_model(ctx.guild.id)
+        await self.bot.get_user_model(ctx.author.id)
 
-        for autoresponse in autoresponses:
-            await self.clone_autoresponse(autoresponse, guild, user)
+        inserted = await insert_autoresponses(ctx.guild.id, ctx.author.id, rows)
+
+        autoresponses = self.cached_autoresponses(ctx.guild.id)
+        if autoresponses is not None:
+            for autoresponse in inserted:
+                autoresponses.add(autoresponse)
 
         await ctx.reply(
             "All the autoresponses have been imported from the provided file!"
@@ -389,9 +406,11 @@ class AutoResponses(BetterCog):
 
         embed.add_field(
             name="Enabled Autoresponses",
-            value=enabled_autoresponses
-            if enabled_autoresponses
-            else "There are no enabled autoresponses in this server!",
+            value=(
+                enabled_autoresponses
+                if enabled_autoresponses
+                else "There are no enabled autoresponses in this server!"
+            ),
             inline=False,
         )
         if disabled_autoresponses:
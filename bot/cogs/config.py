@@ -6,8 +6,9 @@ from discord.ext import commands
 from discord.ext.commands import BucketType
 
 from bot.bot import PeaceBot
+from bot.utils.command_index import toggle_all_channels
 from bot.utils.mixins.better_cog import BetterCog
-from models import CommandModel, GuildModel
+from models import CommandModel
 
 
 class CommandToggleError(commands.CommandError):
@@ -26,7 +27,7 @@ class Config(BetterCog):
     @commands.has_permissions(manage_guild=True)
     @commands.guild_only()
     async def changeprefix(self, ctx: commands.Context, prefix: str):
-        guild = await GuildModel.from_context(ctx)
+        guild = await self.bot.get_guild_model(ctx.guild.id)
         guild.prefix = prefix
         await guild.save(update_fields=["prefix"])
         self.bot.prefixes_cache[ctx.guild.id] = prefix
@@ -110,22 +111,21 @@ class Config(BetterCog):
         if full_command in self.get_commands() or command in ["core", "config"]:
             raise CommandToggleError("You can't enable/disable the core commands!")
 
-        valid_channels = ctx.guild.text_channels if channel == "all" else [ctx.channel]
+        guild = await self.bot.get_guild_model(ctx.guild.id)
+        name = full_command.qualified_name if is_cog else full_command.name
 
-        guild = self.bot.guilds_cache.get(ctx.guild.id)
-
-        for text_channel in valid_channels:
+        if channel == "all":
+            records = await toggle_all_channels(guild, name, is_cog, toggle)
+        else:
             record, _ = await CommandModel.get_or_create(
-                guild=guild,
-                name=full_command.qualified_name if is_cog else full_command.name,
-                channel=text_channel.id,
+                guild=guild, name=name, channel=ctx.channel.id, is_cog=is_cog
             )
-            record.is_cog = is_cog
             record.enabled = toggle
             await record.save()
+            records = [record]
 
-        # Clearing the cache
-        self.bot.commands_cache[ctx.guild.id] = None
+        # Re-indexing the changed records in the cache
+        self.bot.update_commands_cache(ctx.guild.id, records)
 
         toggle_str = "enabled" if toggle else "disabled"
         await ctx.reply(f"`{command}` has been {toggle_str} for `{channel}`!")
@@ -33,6 +33,10 @@ class Core(BetterCog):
         users = len(self.bot.users)
         guilds = len(self.bot.guilds)
 
+        snipe = self.bot.get_cog("Snipe")
+        music = self.bot.get_cog("Music")
+        reddit_cache = self.bot.reddit_cache
+
         embed = Embed(color=Color.dark_green())
         fields = (
             ("Guilds", guilds),
@@ -41,6 +45,19 @@ class Core(BetterCog):
                 "Memory",
                 "{:.4} MB".format(psutil.Process().memory_info().rss / 1024 ** 2),
             ),
+            ("Registration Queue", self.bot.registration_queue.depth),
+            ("Registration Flush", self.bot.registration_queue.flush_latency),
+            ("Pre-Dispatch Latency", self.bot.pre_dispatch_latency),
+            ("Snipe Store", snipe.store_size if snipe else "Not loaded"),
+            ("Track Search Cache", music.search_cache if music else "Not loaded"),
+            (
+                "Reddit Posts",
+                (
+                    f"{reddit_cache.post_count} in {len(reddit_cache.pools)} subreddits"
+                    if reddit_cache
+                    else "Not loaded"
+                ),
+            ),
             ("Python version", ".".join([str(v) for v in sys.version_info[:3]])),
             ("DPY Version", discord_version),
         )
@@ -1,3 +1,4 @@
+import asyncio
 import random
 from typing import Optional, Text, Union
 
@@ -22,6 +23,12 @@ class Leveling(BetterCog):
             1, 60, commands.BucketType.member
         )
         self.leveling_handler = LevelingHandler(self.bot)
+        self.bot.shutdown_hooks.append(self.leveling_handler.flush)
+
+    def cog_unload(self):
+        self.leveling_handler.bulk_update_db.cancel()
+        self.bot.shutdown_hooks.remove(self.leveling_handler.flush)
+        asyncio.create_task(self.leveling_handler.flush())
 
     def get_ratelimit(self, message: discord.Message) -> Optional[int]:
         """Returns the ratelimit left"""
@@ -36,7 +43,7 @@ class Leveling(BetterCog):
         await self.leveling_handler.handle_user_message(message)
 
     @commands.Cog.listener()
-    async def on_user_level_up(self, user_model: LevelingUserModel):
+    async def on_user_level_up(self, user_model: LevelingUserModel, old_level: int):
         if user_model.level == 1:
             return
 
@@ -72,26 +79,24 @@ class Leveling(BetterCog):
     @commands.command(aliases=["ipm6lv"])
     @commands.has_permissions(manage_guild=True)
     async def importmee6levels(self, ctx: commands.Context):
-        await ctx.reply(
+        message = await ctx.reply(
             "**Please Wait!** The wait time may vary according to the number of members in this server!"
         )
         async with ctx.typing():
-            await self.leveling_handler.import_from_mee6(ctx.guild.id)
+            async for progress in self.leveling_handler.import_from_mee6(ctx.guild.id):
+                await message.edit(
+                    content=f"Imported **{progress.players}** members "
+                    + f"from {progress.pages} pages ({progress.throughput:.0f}/s)"
+                )
             await ctx.reply("**Mee6 Data has been imported!**")
 
     @commands.command(aliases=["lb", "top"])
     async def leaderboard(self, ctx: commands.Context):
-        guild_model = self.bot.guilds_cache.get(ctx.guild.id)
-        user_models = (
-            await LevelingUserModel.filter(guild=guild_model)
-            .order_by("-xp")
-            .prefetch_related("user")
-            .limit(10)
-        )
+        leaderboard = await self.leveling_handler.get_leaderboard(ctx.guild.id)
         ranks = "\n".join(
             [
-                f"**{i+1}.** {ctx.guild.get_member(model.user.id)}"
-                for (i, model) in enumerate(user_models)
+                f"**{i+1}.** {ctx.guild.get_member(user_id)}"
+                for (i, (user_id, _)) in enumerate(leaderboard.top(10))
             ]
         )
         ranks_embed = discord.Embed(
@@ -139,6 +144,7 @@ class Leveling(BetterCog):
         guild_model.xp_role_rewards = new_role_rewards
 
         await guild_model.save()
+        self.leveling_handler.invalidate_role_rewards(ctx.guild.id)
         await ctx.reply(
             f"**Added** role rewards for level {level} with role `{role.name}`"
         )
@@ -158,6 +164,7 @@ class Leveling(BetterCog):
         guild_model.xp_role_rewards = role_rewards
 
         await guild_model.save()
+        self.leveling_handler.invalidate_role_rewards(ctx.guild.id)
         await ctx.reply(
             f"**Removed** role rewards for level {level} with role `{removed_role.name}`"
         )
@@ -4,14 +4,19 @@ import logging
 import random
 import re
 import typing as t
+from collections import deque
 from enum import Enum
+from itertools import islice
 
 import discord
 import wavelink
 from discord.ext import commands, tasks
 
 from bot.utils.mixins.better_cog import BetterCog
+from bot.utils.track_cache import TrackSearchCache
+from config.lavalink import lavalink_config
 
+QUEUE_HISTORY_SIZE = 100
 URL_REGEX = r"(?i)\b((?:https?://|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
 OPTIONS = {
     "1️⃣": 0,
@@ -62,6 +67,11 @@ class QueueIsEmpty(commands.CommandError):
         return "Queue is empty!"
 
 
+class InvalidQueuePage(commands.CommandError):
+    def __str__(self) -> str:
+        return "The number of tracks and the page have to be at least 1!"
+
+
 class RepeatMode(Enum):
     NONE = 0
     ONE = 1
@@ -69,68 +79,106 @@ class RepeatMode(Enum):
 
 
 class Queue:
-    def __init__(self):
-        self._queue = []
-        self.position = 0
+    """
+    The current track between a bounded deque of played tracks and a deque of
+    upcoming ones, so that advancing or going back is O(1) regardless of the size.
+    While repeating all, the history is unbounded so that the whole cycle is kept.
+    """
+
+    def __init__(self, history_size: int = 100):
+        self.history_size = history_size
+        self._history: t.Deque = deque(maxlen=history_size)
+        self._current = None
+        self._upcoming: t.Deque = deque()
         self.repeat_mode = RepeatMode.NONE
 
     @property
     def is_empty(self):
-        return not self._queue
+        return not (self._history or self._current is not None or self._upcoming)
 
     @property
     def current_track(self):
-        if not self._queue:
+        if self.is_empty:
             raise QueueIsEmpty()
 
-        if self.position <= len(self._queue) - 1:
-            return self._queue[self.position]
+        return self._current
 
     @property
     def upcoming(self):
-        if not self._queue:
+        if self.is_empty:
             raise QueueIsEmpty()
 
-        return self._queue[self.position + 1 :]
+        return self._upcoming
 
     @property
     def history(self):
-        if not self._queue:
+        if self.is_empty:
             raise QueueIsEmpty()
 
-        return self._queue[: self.position]
+        return self._history
 
     @property
     def length(self):
-        return len(self._queue)
+        return len(self._history) + (self._current is not None) + len(self._upcoming)
+
+    @property
+    def has_next(self) -> bool:
+        if self.is_empty:
+            raise QueueIsEmpty()
+
+        return bool(self._upcoming) or (
+            self.repeat_mode == RepeatMode.ALL
+            and (bool(self._history) or self._current is not None)
+        )
+
+    def upcoming_window(self, count: int, offset: int = 0) -> list:
+        """A page of the upcoming tracks, without copying the rest of them"""
+        return list(islice(self.upcoming, offset, offset + count))
 
     def add(self, *args):
-        self._queue.extend(args)
+        self._upcoming.extend(args)
 
     def get_next_track(self):
-        if not self._queue:
+        if self.is_empty:
             raise QueueIsEmpty()
 
-        self.position += 1
+        if self._current is not None:
+            self._history.append(self._current)
 
-        if self.position < 0:
-            return None
-        elif self.position > len(self._queue) - 1:
-            if self.repeat_mode == RepeatMode.ALL:
-                self.position = 0
-            else:
-                return None
+        if not self._upcoming and self.repeat_mode == RepeatMode.ALL:
+            self._upcoming.extend(self._history)
+            self._history.clear()
 
-        return self._queue[self.position]
+        self._current = self._upcoming.popleft() if self._upcoming else None
+        return self._current
+
+    def rewind(self):
+        """Makes the previous track the next one, along with the current one after it"""
+        if self.is_empty:
+            raise QueueIsEmpty()
+
+        if self._history:
+            previous = self._history.pop()
+        elif self.repeat_mode == RepeatMode.ALL and self._upcoming:
+            # Right after wrapping around, the previous track ends the cycle
+            previous = self._upcoming.pop()
+        else:
+            raise NoPreviousTracks()
+
+        if self._current is not None:
+            self._upcoming.appendleft(self._current)
+        self._upcoming.appendleft(previous)
+        self._current = None
 
     def shuffle(self):
-        if not self._queue:
+        if self.is_empty:
             raise QueueIsEmpty()
 
-        upcoming = self.upcoming
+        # Indexing the middle of a deque isn't O(1), so it's shuffled as a list
+        upcoming = list(self._upcoming)
         random.shuffle(upcoming)
-        self._queue = self._queue[: self.position + 1]
-        self._queue.extend(upcoming)
+        self._upcoming.clear()
+        self._upcoming.extend(upcoming)
 
     def set_repeat_mode(self, mode):
         if mode == "none":
@@ -140,15 +188,21 @@ class Queue:
         elif mode == "all":
             self.repeat_mode = RepeatMode.ALL
 
+        # Only the most recent tracks are kept again once repeating all stops
+        maxlen = None if self.repeat_mode == RepeatMode.ALL else self.history_size
+        if self._history.maxlen != maxlen:
+            self._history = deque(self._history, maxlen=maxlen)
+
     def empty(self):
-        self._queue.clear()
-        self.position = 0
+        self._history.clear()
+        self._current = None
+        self._upcoming.clear()
 
 
 class Player(wavelink.Player):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, history_size: int = 100, **kwargs):
         super().__init__(*args, **kwargs)
-        self.queue = Queue()
+        self.queue = Queue(history_size)
 
     async def connect(self, ctx, channel=None):
         if self.is_connected:
@@ -223,7 +277,10 @@ class Player(wavelink.Player):
             return tracks[OPTIONS[reaction.emoji]]
 
     async def start_playback(self):
-        await self.play(self.queue.current_track)
+        # Nothing is current before the first track or after the queue has ended
+        if (track := self.queue.current_track) is None:
+            track = self.queue.get_next_track()
+        await self.play(track)
 
     async def advance(self):
         try:
@@ -240,9 +297,14 @@ class Music(BetterCog, wavelink.WavelinkMixin):
     def __init__(self, bot):
         self.bot = bot
         self.wavelink = wavelink.Client(bot=bot)
+        self.search_cache = TrackSearchCache()
         self.start_nodes.start()
+        self.migrate_players.start()
         super().__init__(bot)
 
+    def cog_unload(self):
+        self.migrate_players.cancel()
+
     @commands.Cog.listener()
     async def on_voice_state_update(self, member, before, after):
         if not member.bot and after.channel is None:
@@ -274,26 +336,86 @@ class Music(BetterCog, wavelink.WavelinkMixin):
         await self.bot.wait_until_ready()
         logging.info("Starting wavelink nodes")
 
-        nodes = {
-            "MAIN": {
-                "host": "lavalink",
-                "port": 2333,
-                "password": "youshallnotpass",
-                "identifier": "MAIN",
-                "region": "india",
-                "rest_uri": "http://lavalink:2333",
-            }
-        }
-
-        for node in nodes.values():
-            await self.wavelink.initiate_node(**node)
+        results = await asyncio.gather(
+            *(
+                self.wavelink.initiate_node(
+                    host=node.host,
+                    port=node.port,
+                    rest_uri=node.rest_uri,
+                    password=node.password,
+                    identifier=node.identifier,
+                    region=node.region,
+                )
+                for node in lavalink_config.nodes
+            ),
+            return_exceptions=True,
+        )
+        for node, result in zip(lavalink_config.nodes, results):
+            if isinstance(result, Exception):
+                logging.error(f"Wavelink node `{node.identifier}` failed: {result!r}")
         logging.info("Wavelink nodes started!")
 
+    @staticmethod
+    def node_load(node: wavelink.Node) -> float:
+        if not node.stats:
+            return len(node.players)
+
+        # Stats are only sent every minute, so the live player count replaces theirs
+        return node.stats.penalty.total - node.stats.playing_players + len(node.players)
+
+    def best_node(self) -> t.Optional[wavelink.Node]:
+        """The available node with the lowest load, from its players and CPU usage"""
+        nodes = [node for node in self.wavelink.nodes.values() if node.is_available]
+        if not nodes:
+            return None
+        return min(nodes, key=self.node_load)
+
+    @tasks.loop(seconds=10)
+    async def migrate_players(self):
+        """Moves the players of disconnected nodes to the best available ones"""
+        for node in list(self.wavelink.nodes.values()):
+            if node.is_available or not node.players:
+                continue
+
+            for player in list(node.players.values()):
+                target = self.best_node()
+                if not target:
+                    logging.warning("No wavelink node is available to migrate to")
+                    return
+
+                try:
+                    await player.change_node(target.identifier)
+                except Exception:
+                    logging.exception(
+                        f"Failed to migrate the player of {player.guild_id} "
+                        f"from `{node.identifier}` to `{target.identifier}`"
+                    )
+
+    @migrate_players.before_loop
+    async def before_migrate_players(self):
+        await self.bot.wait_until_ready()
+
     def get_player(self, obj):
+        guild_id = obj.guild.id if isinstance(obj, commands.Context) else obj.id
+
+        # New players are placed on the least loaded node
+        node_id = None
+        if guild_id not in self.wavelink.players:
+            node = self.best_node()
+            node_id = node.identifier if node else None
+
         if isinstance(obj, commands.Context):
-            return self.wavelink.get_player(obj.guild.id, cls=Player, context=obj)
+            return self.wavelink.get_player(
+                obj.guild.id,
+                cls=Player,
+                node_id=node_id,
+                context=obj,
+                history_size=QUEUE_HISTORY_SIZE,
+            )
         elif isinstance(obj, discord.Guild):
-            return self.wavelink.get_player(obj.id, cls=Player)
+            return self.wavelink.get_player(
+                obj.id, cls=Player, node_id=node_id, history_size=QUEUE_HISTORY_SIZE
+            )
 
     @commands.command(name="connect", aliases=["join"])
     async def connect_command(self, ctx, *, channel: t.Optional[discord.VoiceChannel]):
@@ -330,10 +452,12 @@ class Music(BetterCog, wavelink.WavelinkMixin):
 
         else:
             query = query.strip("<>")
-            if not re.match(URL_REGEX, query):
-                query = f"ytsearch:{query}"
+            if re.match(URL_REGEX, query):
+                tracks = await self.wavelink.get_tracks(query)
+            else:
+                tracks = await self.search_cache.search(query, self.wavelink.get_tracks)
 
-            await player.add_tracks(ctx, await self.wavelink.get_tracks(query))
+            await player.add_tracks(ctx, tracks)
 
     @play_command.error
     async def play_command_error(self, ctx, exc):
@@ -368,7 +492,7 @@ class Music(BetterCog, wavelink.WavelinkMixin):
     async def next_command(self, ctx):
         player = self.get_player(ctx)
 
-        if not player.queue.upcoming:
+        if not player.queue.has_next:
             raise NoMoreTracks("Queue has ended!")
 
         await player.stop()
@@ -387,11 +511,12 @@ class Music(BetterCog, wavelink.WavelinkMixin):
     async def previous_command(self, ctx):
         player = self.get_player(ctx)
 
-        if not player.queue.history:
-            raise NoPreviousTracks("There is no previous song!")
-
-        player.queue.position -= 2
-        await player.stop()
+        player.queue.rewind()
+        # Stopping advances to the previous track, which isn't dispatched when idle
+        if player.is_playing:
+            await player.stop()
+        else:
+            await player.advance()
         await ctx.send("Playing previous track in queue.")
 
     @previous_command.error
@@ -424,15 +549,19 @@ class Music(BetterCog, wavelink.WavelinkMixin):
         await ctx.send(f"The repeat mode has been set to {mode}.")
 
     @commands.command(name="queue")
-    async def queue_command(self, ctx, show: t.Optional[int] = 10):
+    async def queue_command(self, ctx, show: t.Optional[int] = 10, page: int = 1):
         player = self.get_player(ctx)
 
         if player.queue.is_empty:
             raise QueueIsEmpty("Queue is empty!")
 
+        if show < 1 or page < 1:
+            raise InvalidQueuePage()
+
+        offset = (page - 1) * show
         embed = discord.Embed(
             title="Queue",
-            description=f"Showing up to next {show} tracks",
+            description=f"Showing up to {show} tracks, from #{offset + 1}",
             colour=ctx.author.colour,
             timestamp=dt.datetime.utcnow(),
         )
@@ -448,10 +577,10 @@ class Music(BetterCog, wavelink.WavelinkMixin):
             ),
             inline=False,
         )
-        if upcoming := player.queue.upcoming:
+        if upcoming := player.queue.upcoming_window(show, offset):
             embed.add_field(
                 name="Next up",
-                value="\n".join(t.title for t in upcoming[:show]),
+                value="\n".join(t.title for t in upcoming),
                 inline=False,
             )
 
@@ -461,6 +590,8 @@ class Music(BetterCog, wavelink.WavelinkMixin):
     async def queue_command_error(self, ctx, exc):
         if isinstance(exc, QueueIsEmpty):
             await ctx.send("The queue is currently empty.")
+        elif isinstance(exc, InvalidQueuePage):
+            await ctx.send(str(exc))
 
 
 def setup(bot):
@@ -1,6 +1,5 @@
 from discord.ext import commands
 
-from bot.utils.cached_reddit import RedditPostCacher
 from bot.utils.mixins.better_cog import BetterCog
 
 
@@ -18,8 +17,8 @@ class NSFW(BetterCog):
             "hentai",
             "grool",
         )
-        self.cache = RedditPostCacher(self.subreddits, "cache/NSFW.pickle")
-        self.cache.cache_posts.start()
+        self.cache = bot.get_reddit_cache()
+        self.cache.register(self.subreddits)
         super().__init__(bot)
 
     def cog_help_check(self, ctx: commands.Context):
@@ -2,7 +2,6 @@ import discord
 from discord.ext import commands
 
 from bot.bot import PeaceBot
-from bot.utils.cached_reddit import RedditPostCacher
 from bot.utils.mixins.better_cog import BetterCog
 
 
@@ -10,8 +9,8 @@ class Reddit(BetterCog):
     def __init__(self, bot: PeaceBot):
         self.bot = bot
         self.subreddits = ("aww", "memes", "cursedcomments")
-        self.cache = RedditPostCacher(self.subreddits, "cache/Reddit.pickle")
-        self.cache.cache_posts.start()
+        self.cache = bot.get_reddit_cache()
+        self.cache.register(self.subreddits)
         super().__init__(bot)
 
     @commands.command(aliases=["memes"])
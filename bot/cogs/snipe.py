@@ -1,11 +1,12 @@
-from datetime import datetime
+from typing import Optional
 
-from cachetools import TTLCache
+import discord
 from discord import Color, Embed
 from discord.ext import commands
 from discord.ext.commands import BucketType
 
 from bot.utils.mixins.better_cog import BetterCog
+from bot.utils.snipe_store import MessageContentStore, SnipeRecord, SnipeStore
 
 
 class NoSnipeableMessage(commands.CommandError):
@@ -16,63 +17,149 @@ class NoSnipeableMessage(commands.CommandError):
 class Snipe(BetterCog):
     def __init__(self, bot, *args, **kwargs):
         self.bot = bot
-        self.delete_snipes = TTLCache(100, 600)
-        self.edit_snipes = TTLCache(100, 600)
+        self.delete_snipes = SnipeStore()
+        self.edit_snipes = SnipeStore()
+        # Deletes/edits arrive as raw events, the content comes from here instead
+        self.message_contents = MessageContentStore()
+        # Most messages recorded from a single bulk delete in a channel
+        self.bulk_delete_limit = self.delete_snipes.history_size
         super().__init__(bot)
 
+    @property
+    def store_size(self) -> str:
+        self.delete_snipes.expire()
+        self.edit_snipes.expire()
+        records = self.delete_snipes.records + self.edit_snipes.records
+        size = (
+            self.delete_snipes.size + self.edit_snipes.size + self.message_contents.size
+        )
+        return (
+            f"{records} messages | {len(self.message_contents)} recent | "
+            f"{size / 1024:.1f} KB"
+        )
+
+    async def snipe_enabled(self, message: discord.Message) -> bool:
+        commands_cache = await self.bot.get_commands_cache(message.guild.id)
+        return not (
+            commands_cache.command_disabled(message.channel.id, "snipe")
+            or commands_cache.cog_disabled(message.channel.id, self.qualified_name)
+        )
+
+    async def cached_record(
+        self, cached_message: Optional[discord.Message]
+    ) -> Optional[SnipeRecord]:
+        # Held to the same checks as the messages recorded in `on_message`
+        if (
+            not cached_message
+            or cached_message.author.bot
+            or not cached_message.guild
+            or not await self.snipe_enabled(cached_message)
+        ):
+            return None
+        return SnipeRecord.from_message(cached_message)
+
+    async def pop_record(
+        self, message_id: int, cached_message: Optional[discord.Message]
+    ) -> Optional[SnipeRecord]:
+        record = self.message_contents.pop(message_id)
+        if record is None:
+            record = await self.cached_record(cached_message)
+        return record
+
     @commands.Cog.listener()
-    async def on_message_delete(self, message):
-        if message.author.bot:
+    async def on_message(self, message: discord.Message):
+        if message.author.bot or not message.guild:
             return
 
-        self.delete_snipes[message.channel] = message
+        if await self.snipe_enabled(message):
+            self.message_contents.add(message)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        record = await self.pop_record(payload.message_id, payload.cached_message)
+        if record:
+            self.delete_snipes.add(payload.channel_id, record)
 
     @commands.Cog.listener()
-    async def on_message_edit(self, before, after):
-        if before.author.bot:
+    async def on_raw_bulk_message_delete(
+        self, payload: discord.RawBulkMessageDeleteEvent
+    ):
+        cached_messages = {message.id: message for message in payload.cached_messages}
+
+        records = []
+        # Newest first, as only the last `bulk_delete_limit` messages are recorded
+        for message_id in sorted(payload.message_ids, reverse=True):
+            record = await self.pop_record(message_id, cached_messages.get(message_id))
+            if record and len(records) < self.bulk_delete_limit:
+                records.append(record)
+
+        for record in reversed(records):
+            self.delete_snipes.add(payload.channel_id, record)
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        # Embeds being resolved also dispatches this, without any content
+        content = payload.data.get("content")
+        if content is None:
+            return
+
+        record = self.message_contents.get(payload.message_id)
+        if record is None:
+            record = await self.cached_record(payload.cached_message)
+            if record is None:
+                return
+
+        if record.content == content:
             return
 
-        self.edit_snipes[after.channel] = (before, after)
+        edited_at = discord.utils.parse_time(payload.data.get("edited_timestamp"))
+        edited = record._replace(content=content, edited_at=edited_at)
+
+        self.message_contents.update(payload.message_id, edited)
+        self.edit_snipes.add(payload.channel_id, edited._replace(before=record.content))
+
+    def get_snipe(self, store: SnipeStore, ctx: commands.Context, index: int):
+        record = store.get(ctx.channel.id, index - 1)
+        if not record:
+            raise NoSnipeableMessage()
+        return record
 
     @commands.group(name="snipe")
     @commands.cooldown(1, 5, BucketType.user)
     @commands.guild_only()
     @commands.bot_has_permissions(send_messages=True, read_messages=True)
-    async def snipe_group(self, ctx):
-        """Snipe a deleted message"""
+    async def snipe_group(self, ctx, index: Optional[int] = None):
+        """Snipe a deleted message, `index` goes back through the recent ones"""
         if ctx.invoked_subcommand is None:
-            try:
-                sniped_message = self.delete_snipes[ctx.channel]
-            except KeyError:
-                raise NoSnipeableMessage()
-            else:
-                result = Embed(
-                    color=Color.red(),
-                    description=sniped_message.content,
-                    timestamp=sniped_message.created_at,
-                )
-                result.set_author(
-                    name=sniped_message.author.display_name,
-                    icon_url=sniped_message.author.avatar_url,
-                )
-                await ctx.reply(embed=result)
+            sniped_message = self.get_snipe(self.delete_snipes, ctx, index or 1)
 
-    @snipe_group.command(name="edit")
-    async def snipe_edit(self, ctx):
-        """Snipes an edited message"""
-        try:
-            before, after = self.edit_snipes[ctx.channel]
-        except KeyError:
-            raise NoSnipeableMessage()
-        else:
-            result = Embed(color=Color.red(), timestamp=after.edited_at)
-            result.add_field(name="Before", value=before.content, inline=False)
-            result.add_field(name="After", value=after.content, inline=False)
+            result = Embed(
+                color=Color.red(),
+                description=sniped_message.content,
+                timestamp=sniped_message.created_at,
+            )
             result.set_author(
-                name=after.author.display_name, icon_url=after.author.avatar_url
+                name=sniped_message.author_name,
+                icon_url=sniped_message.avatar_url,
             )
             await ctx.reply(embed=result)
 
+    @snipe_group.command(name="edit")
+    async def snipe_edit(self, ctx, index: int = 1):
+        """Snipes an edited message, `index` goes back through the recent ones"""
+        sniped_message = self.get_snipe(self.edit_snipes, ctx, index)
+
+        result = Embed(
+            color=Color.red(),
+            timestamp=sniped_message.edited_at or sniped_message.created_at,
+        )
+        result.add_field(name="Before", value=sniped_message.before, inline=False)
+        result.add_field(name="After", value=sniped_message.content, inline=False)
+        result.set_author(
+            name=sniped_message.author_name, icon_url=sniped_message.avatar_url
+        )
+        await ctx.reply(embed=result)
+
 
 def setup(bot, *args, **kwargs):
     bot.add_cog(Snipe(bot, *args, **kwargs))
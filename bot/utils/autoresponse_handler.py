@@ -1,12 +1,14 @@
 import re
-from typing import List, Tuple
+from operator import attrgetter
+from string import Formatter
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import discord
-from cachetools import TTLCache
 from discord.ext import commands
 
 from bot.bot import PeaceBot
 from bot.utils.mixins.better_cog import BetterCog
+from bot.utils.model_cache import ModelCache
 from models import AutoResponseModel
 
 
@@ -14,39 +16,257 @@ class AutoResponseError(commands.CommandError):
     pass
 
 
+# Attributes allowed in response variables, `""` being the variable itself
+_MEMBER_ATTRIBUTES = frozenset(
+    ("", "mention", "name", "display_name", "nick", "id", "discriminator", "avatar_url")
+)
+_TEMPLATE_VARIABLES = {
+    "author": _MEMBER_ATTRIBUTES,
+    "mentioned": _MEMBER_ATTRIBUTES,
+    "server": frozenset(("", "name", "id", "member_count", "icon_url")),
+    "message": frozenset(("",)),
+    # The whole message, which older responses were formatted with
+    "raw_message": frozenset(
+        (
+            "content",
+            "clean_content",
+            "jump_url",
+            "id",
+            "channel",
+            "channel.mention",
+            "channel.name",
+            "channel.id",
+        )
+    ),
+}
+
+
+class ResponseTemplate:
+    """
+    A response parsed once into a format string over flat keys,
+    so that rendering only computes the strings it references
+    """
+
+    def __init__(self, response: str):
+        self.response = response
+        # Flat key -> (variable, attribute) it is rendered from
+        self.fields: Dict[str, Tuple[str, str]] = {}
+
+        parts = []
+        try:
+            parsed = list(Formatter().parse(response))
+        except ValueError as error:
+            raise AutoResponseError(f"The response has invalid braces: {error}")
+
+        for literal, field_name, format_spec, conversion in parsed:
+            parts.append(literal.replace("{", "{{").replace("}", "}}"))
+            if field_name is None:
+                continue
+
+            key = self._compile_field(field_name)
+            if format_spec and "{" in format_spec:
+                raise AutoResponseError(
+                    f"`{field_name}` cannot have nested variables in its format!"
+                )
+
+            conversion = f"!{conversion}" if conversion else ""
+            format_spec = f":{format_spec}" if format_spec else ""
+            parts.append(f"{{{key}{conversion}{format_spec}}}")
+
+        self._format = "".join(parts)
+        self.variables = frozenset(variable for variable, _ in self.fields.values())
+
+    def _compile_field(self, field_name: str) -> str:
+        variable, _, attribute = field_name.partition(".")
+        allowed = _TEMPLATE_VARIABLES.get(variable)
+
+        if allowed is None or attribute not in allowed:
+            raise AutoResponseError(f"`{field_name}` is not a valid arguement!")
+
+        # Dots would be attribute lookups again in the format string
+        key = f"{variable}_{attribute.replace('.', '_')}" if attribute else variable
+        self.fields[key] = (variable, attribute)
+        return key
+
+    def render(self, message: discord.Message) -> str:
+        objects = {}
+        if "mentioned" in self.variables:
+            if not message.mentions:
+                raise AutoResponseError("You need to mention someone for this to work!")
+            objects["mentioned"] = message.mentions[0]
+
+        if "message" in self.variables:
+            _, _, message_content = message.content.partition(" ")
+            if not message_content:
+                raise AutoResponseError(
+                    "You need to write some extra message for this to work!"
+                )
+            objects["message"] = message_content
+
+        if "author" in self.variables:
+            objects["author"] = message.author
+        if "server" in self.variables:
+            objects["server"] = message.guild
+        if "raw_message" in self.variables:
+            objects["raw_message"] = message
+
+        values = {
+            key: (
+                str(attrgetter(attribute)(objects[variable]))
+                if attribute
+                else str(objects[variable])
+            )
+            for key, (variable, attribute) in self.fields.items()
+        }
+        return self._format.format_map(values)
+
+
+class AutoResponseMatcher:
+    """
+    Token-prefix trie over the enabled triggers of a guild,
+    so that a message is matched in O(tokens) regardless of the trigger count
+    """
+
+    # Key of the autoresponse ending at a node, tokens are never `None`
+    _END = None
+
+    def __init__(self, autoresponses: List[AutoResponseModel]):
+        self._root: Dict = {}
+
+        for autoresponse in autoresponses:
+            if autoresponse.enabled:
+                self.add(autoresponse)
+
+    def add(self, autoresponse: AutoResponseModel) -> None:
+        node = self._root
+        for token in autoresponse.trigger.split():
+            node = node.setdefault(token, {})
+        node[self._END] = autoresponse
+
+    def remove(self, autoresponse: AutoResponseModel) -> None:
+        path = [self._root]
+        tokens = autoresponse.trigger.split()
+        for token in tokens:
+            node = path[-1].get(token)
+            if node is None:
+                return
+            path.append(node)
+
+        if path[-1].get(self._END) is not autoresponse:
+            return
+        del path[-1][self._END]
+
+        # Prunes the nodes left without any trigger
+        for depth in range(len(tokens), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][tokens[depth - 1]]
+
+    def match(self, tokens: List[str]) -> Optional[AutoResponseModel]:
+        """Returns the autoresponse with the longest trigger the tokens start with"""
+        node = self._root
+        match = node.get(self._END)
+
+        for token in tokens:
+            node = node.get(token)
+            if node is None:
+                break
+            match = node.get(self._END, match)
+
+        return match
+
+
+class GuildAutoResponses:
+    """
+    The autoresponses of a guild along with their compiled matcher.
+    Changes are applied here directly instead of reloading the guild from the db.
+    """
+
+    def __init__(self, autoresponses: List[AutoResponseModel]):
+        self._autoresponses: Dict[str, AutoResponseModel] = {
+            autoresponse.trigger: autoresponse for autoresponse in autoresponses
+        }
+        self.matcher = AutoResponseMatcher(autoresponses)
+        # Trigger -> compiled response, or the error it failed to compile with
+        self._templates: Dict[str, Union[ResponseTemplate, AutoResponseError]] = {}
+
+        for autoresponse in autoresponses:
+            self._compile(autoresponse)
+
+    def __iter__(self) -> Iterator[AutoResponseModel]:
+        return iter(self._autoresponses.values())
+
+    def __len__(self) -> int:
+        return len(self._autoresponses)
+
+    def get(self, trigger: str) -> Optional[AutoResponseModel]:
+        return self._autoresponses.get(trigger)
+
+    def add(self, autoresponse: AutoResponseModel) -> None:
+        previous = self._autoresponses.get(autoresponse.trigger)
+        if previous is not None:
+            self.remove(previous)
+
+        self._autoresponses[autoresponse.trigger] = autoresponse
+        self._compile(autoresponse)
+        if autoresponse.enabled:
+            self.matcher.add(autoresponse)
+
+    def remove(self, autoresponse: AutoResponseModel) -> None:
+        # The stored model may be another instance of the same autoresponse
+        stored = self._autoresponses.pop(autoresponse.trigger, None)
+        self._templates.pop(autoresponse.trigger, None)
+        if stored is not None:
+            self.matcher.remove(stored)
+
+    def clear(self) -> None:
+        self._autoresponses.clear()
+        self._templates.clear()
+        self.matcher = AutoResponseMatcher([])
+
+    def _compile(self, autoresponse: AutoResponseModel) -> None:
+        if not autoresponse.has_variables:
+            self._templates.pop(autoresponse.trigger, None)
+            return
+
+        # Responses saved before templates were validated only fail when triggered
+        try:
+            self._templates[autoresponse.trigger] = ResponseTemplate(
+                autoresponse.response
+            )
+        except AutoResponseError as error:
+            self._templates[autoresponse.trigger] = error
+
+    def template(self, autoresponse: AutoResponseModel) -> ResponseTemplate:
+        template = self._templates.get(autoresponse.trigger)
+        if template is None:
+            template = ResponseTemplate(autoresponse.response)
+            self._templates[autoresponse.trigger] = template
+        if isinstance(template, AutoResponseError):
+            raise template
+        return template
+
+    @classmethod
+    async def from_guild_id(cls, guild_id: int):
+        return cls(await AutoResponseModel.filter(guild__id=guild_id))
+
+
 class AutoResponseHandler:
-    def __init__(
-        self, bot: PeaceBot, message: discord.Message, autoresponse_cache: TTLCache
-    ):
+    """
+    Long-lived autoresponse matcher shared by all the messages, owned by the cog.
+    Everything before sending the response is synchronous once the guild is cached.
+    """
+
+    def __init__(self, bot: PeaceBot, autoresponse_cache: ModelCache):
         self._bot = bot
-        self._message = message
-        self._guild_id = message.guild.id
         self._autoresponse_cache = autoresponse_cache
 
     @property
     def autoresponse_models_cache(self):
         return self._autoresponse_cache
 
-    @autoresponse_models_cache.setter
-    def autoresponse_models_cache(self, autoresponse_cache: TTLCache):
-        self._autoresponse_cache = autoresponse_cache
-
-    @property
-    def discord_message(self):
-        return self._message
-
-    @discord_message.setter
-    def discord_message(self, new_message: discord.Message):
-        self._message = new_message
-
-    async def autoresponses(self):
-        return await self.guild_autoresponses(self._guild_id)
-
-    async def filtered_autoresponses(self):
-        return await self.guild_filtered_autoresponses(await self.autoresponses())
-
-    async def message_is_valid(self):
-        message = self._message
+    @staticmethod
+    def message_is_valid(message: discord.Message) -> bool:
         if (
             message.author.bot
             or message.embeds
@@ -56,111 +276,34 @@ class AutoResponseHandler:
             return False
         return True
 
-    async def guild_autoresponses(self, guild_id: int):
-        autoresponses = self._autoresponse_cache.get(guild_id)
-        if not autoresponses:
-            autoresponses = await self.update_autoresponse_cache(guild_id)
-        return autoresponses
-
-    async def guild_filtered_autoresponses(
-        self, guild_autoresponses: List[AutoResponseModel]
-    ):
-        check = lambda m, l: self._message.content.split()[:l] == m.trigger.split()
-
-        try:
-            # Gets the first autoresponse object if the sent message is an autoresponse trigger
-            filtered_autoresponses = [
-                autoresponse
-                for autoresponse in guild_autoresponses
-                if autoresponse.enabled
-                and check(autoresponse, len(autoresponse.trigger.split()))
-            ]
-            # Sorts the autoresponses according to the length of trigger
-            filtered_autoresponses.sort(key=lambda x: x.trigger, reverse=True)
-            return filtered_autoresponses[0]
-        except IndexError or TypeError as error:
-            return
+    async def guild_autoresponses(self, guild_id: int) -> GuildAutoResponses:
+        return await self._autoresponse_cache.get_or_load(
+            guild_id, lambda: GuildAutoResponses.from_guild_id(guild_id)
+        )
 
     async def _autoresponse_error_handler(
         self, message: discord.Message, error: Exception
     ):
         title = " ".join(re.compile(r"[A-Z][a-z]*").findall(error.__class__.__name__))
-        description = str(error)
 
         embed = discord.Embed(
             title=title, description=str(error), color=discord.Color.red()
         )
-        await self._message.channel.send(embed=embed)
+        await message.channel.send(embed=embed)
         raise error
 
-    @staticmethod
-    async def update_provided_autoresponse_cache(
-        guild_id: int, autoresponse_cache: TTLCache
-    ):
-        autoresponses = await AutoResponseModel.filter(guild__id=guild_id)
-        autoresponse_cache[guild_id] = autoresponses
-        return (autoresponses, autoresponse_cache)
-
-    async def update_autoresponse_cache(self, guild_id: int) -> List[AutoResponseModel]:
-        autoresponses, cache = await self.update_provided_autoresponse_cache(
-            guild_id, self._autoresponse_cache
-        )
-        self._autoresponse_cache = cache
-        return autoresponses
-
-    async def _autoresponse_message_formatter(
-        self, message: discord.Message, response: str
-    ) -> str:
-        try:
-            # Checks if the mentions is needed in response
-            mentioned = message.mentions[0] if "{mentioned" in response else None
-        except IndexError:
-            raise AutoResponseError("You need to mention someone for this to work!")
-
-        message_content = (
-            " ".join(message.content.split(" ")[1:])
-            if "{message}" in response
-            else None
-        )
-
-        if message_content == "":
-            raise AutoResponseError(
-                "You need to write some extra message for this to work!"
-            )
-
-        try:
-            updated_message = response.format(
-                author=message.author,
-                message=message_content,
-                raw_message=message,
-                server=message.guild,
-                mentioned=mentioned,
-            )
-        except KeyError as error:
-            raise AutoResponseError(
-                f"""{str(error).replace("'", "`")} is not a valid arguement!"""
-            )
-        return updated_message
-
-    async def _extra_arguements_handler(self, autoresponse_model: AutoResponseModel):
-        len_of_trigger = len(autoresponse_model.trigger.split())
-
-        check = (
-            lambda m: self._message.content.split()[:len_of_trigger]
-            == m.trigger.split()
-        )
-
-        if autoresponse_model.has_variables and check(autoresponse_model):
-            output = await self._autoresponse_message_formatter(
-                self._message, autoresponse_model.response
-            )
-        elif autoresponse_model.trigger == self._message.content:
+    def _extra_arguements_handler(
+        self,
+        message: discord.Message,
+        autoresponse_model: AutoResponseModel,
+        guild_autoresponses: GuildAutoResponses,
+    ) -> Optional[str]:
+        # The matcher only returns autoresponses whose trigger the message starts with
+        if autoresponse_model.has_variables:
+            output = guild_autoresponses.template(autoresponse_model).render(message)
+        elif autoresponse_model.trigger == message.content:
             output = autoresponse_model.response
-        elif (
-            autoresponse_model.extra_arguements
-            and self._message.content.split()[:len_of_trigger]
-            == autoresponse_model.trigger.split()
-        ):
+        elif autoresponse_model.extra_arguements:
             output = autoresponse_model.response
         else:
             output = None
@@ -168,18 +311,33 @@ class AutoResponseHandler:
         if output:
             return output
 
-    async def run(self):
-        try:
-            if not await self.message_is_valid():
-                return
+    def response_for(
+        self, message: discord.Message, guild_autoresponses: GuildAutoResponses
+    ) -> Optional[str]:
+        autoresponse = guild_autoresponses.matcher.match(message.content.split())
 
-            filtered_autoresponses = await self.filtered_autoresponses()
+        if not autoresponse:
+            return
 
-            if not filtered_autoresponses:
-                return
+        return self._extra_arguements_handler(
+            message, autoresponse, guild_autoresponses
+        )
 
-            output = await self._extra_arguements_handler(filtered_autoresponses)
-            return output
+    async def run(self, message: discord.Message) -> None:
+        """Sends the autoresponse for the message, if it triggers any"""
+        if not self.message_is_valid(message):
+            return
+
+        guild_autoresponses = self._autoresponse_cache.get(message.guild.id)
+        if guild_autoresponses is None:
+            guild_autoresponses = await self.guild_autoresponses(message.guild.id)
 
+        try:
+            output = self.response_for(message, guild_autoresponses)
         except Exception as error:
-            await self._autoresponse_error_handler(self._message, error)
+            await self._autoresponse_error_handler(message, error)
+
+        if not output:
+            return
+
+        await message.channel.send(output)
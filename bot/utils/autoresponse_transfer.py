@@ -0,0 +1,169 @@
+import json
+from typing import Iterable, Iterator, List, NamedTuple, Tuple
+
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
+
+from bot.utils.autoresponse_handler import AutoResponseError, ResponseTemplate
+from models import AutoResponseModel
+
+EXPORT_FORMAT = "peacebot-autoresponses"
+EXPORT_VERSION = 1
+IMPORT_CHUNK_SIZE = 500
+
+
+class AutoResponseRow(NamedTuple):
+    trigger: str
+    response: str
+    enabled: bool
+    extra_arguements: bool
+    has_variables: bool
+
+
+def export_lines(autoresponses: Iterable[AutoResponseModel]) -> Iterator[str]:
+    """
+    Yields a JSON Lines export: a header line with the format version,
+    followed by one line per autoresponse
+    """
+    yield json.dumps({"format": EXPORT_FORMAT, "version": EXPORT_VERSION}) + "\n"
+
+    for autoresponse in autoresponses:
+        row = AutoResponseRow(
+            autoresponse.trigger,
+            autoresponse.response,
+            autoresponse.enabled,
+            autoresponse.extra_arguements,
+            autoresponse.has_variables,
+        )
+        yield json.dumps(row._asdict()) + "\n"
+
+
+def _parse_row(line_number: int, line: str) -> AutoResponseRow:
+    try:
+        data = json.loads(line)
+    except ValueError:
+        raise AutoResponseError(f"Line {line_number} is not valid JSON!")
+
+    if not isinstance(data, dict):
+        raise AutoResponseError(f"Line {line_number} is not an autoresponse!")
+
+    trigger = data.get("trigger")
+    response = data.get("response")
+    if not isinstance(trigger, str) or not trigger.strip():
+        raise AutoResponseError(f"Line {line_number} has an invalid trigger!")
+    if not isinstance(response, str) or not response:
+        raise AutoResponseError(f"Line {line_number} has an invalid response!")
+
+    flags = []
+    for name, default in (
+        ("enabled", True),
+        ("extra_arguements", False),
+        ("has_variables", False),
+    ):
+        value = data.get(name, default)
+        if not isinstance(value, bool):
+            raise AutoResponseError(f"Line {line_number} has an invalid `{name}`!")
+        flags.append(value)
+
+    row = AutoResponseRow(trigger.lower(), response, *flags)
+    if row.has_variables:
+        try:
+            ResponseTemplate(row.response)
+        except AutoResponseError as error:
+            raise AutoResponseError(f"Line {line_number}: {error}")
+
+    return row
+
+
+def parse_lines(lines: Iterable[str]) -> List[AutoResponseRow]:
+    """
+    Validates a JSON Lines export, rows repeating a trigger are dropped.
+    Nothing is returned unless every row is valid.
+    """
+    lines = iter(lines)
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError):
+        header = None
+
+    if (
+        not isinstance(header, dict)
+        or header.get("format") != EXPORT_FORMAT
+        or header.get("version") != EXPORT_VERSION
+    ):
+        raise AutoResponseError("This is not a supported autoresponse export!")
+
+    rows = {}
+    for line_number, line in enumerate(lines, start=2):
+        if not line.strip():
+            continue
+        row = _parse_row(line_number, line)
+        rows.setdefault(row.trigger, row)
+
+    return list(rows.values())
+
+
+async def insert_autoresponses(
+    guild_id: int, user_id: int, rows: List[AutoResponseRow]
+) -> List[AutoResponseModel]:
+    """
+    Inserts the rows in chunks of one query each, skipping triggers
+    which already exist in the guild. Returns the inserted autoresponses.
+    """
+    table = AutoResponseModel._meta.db_table
+    inserted_ids = []
+
+    async with in_transaction() as connection:
+        for start in range(0, len(rows), IMPORT_CHUNK_SIZE):
+            chunk = rows[start : start + IMPORT_CHUNK_SIZE]
+            _, inserted = await connection.execute_query(
+                f'INSERT INTO "{table}" '
+                '("id", "guild_id", "created_by_id", "trigger", "response", '
+                '"enabled", "extra_arguements", "has_variables") '
+                "SELECT gen_random_uuid(), $1, $2, data.* "
+                "FROM unnest($3::text[], $4::text[], $5::bool[], $6::bool[], "
+                "$7::bool[]) AS data(trigger, response, enabled, "
+                "extra_arguements, has_variables) "
+                'ON CONFLICT ("guild_id", "trigger") DO NOTHING '
+                'RETURNING "id"',
+                [guild_id, user_id, *(list(column) for column in zip(*chunk))],
+            )
+            inserted_ids.extend(row["id"] for row in inserted)
+
+    if not inserted_ids:
+        return []
+    return await AutoResponseModel.filter(id__in=inserted_ids)
+
+
+async def clone_guild_autoresponses(
+    source_guild_id: int, guild_id: int, user_id: int
+) -> Tuple[int, List[AutoResponseModel]]:
+    """
+    Copies every autoresponse of the source guild in a single query,
+    skipping triggers which already exist in the guild.
+    Returns the number of source autoresponses and the inserted ones.
+    """
+    table = AutoResponseModel._meta.db_table
+    connection = Tortoise.get_connection("default")
+    _, result = await connection.execute_query(
+        "WITH source AS ("
+        'SELECT "trigger", "response", "extra_arguements", "has_variables" '
+        f'FROM "{table}" WHERE "guild_id" = $1'
+        "), inserted AS ("
+        f'INSERT INTO "{table}" '
+        '("id", "guild_id", "created_by_id", "trigger", "response", '
+        '"enabled", "extra_arguements", "has_variables") '
+        "SELECT gen_random_uuid(), $2, $3, source.trigger, source.response, "
+        "TRUE, source.extra_arguements, source.has_variables FROM source "
+        'ON CONFLICT ("guild_id", "trigger") DO NOTHING '
+        'RETURNING "id"'
+        ") "
+        "SELECT (SELECT count(*) FROM source) AS total, "
+        "(SELECT array_agg(id) FROM inserted) AS inserted_ids",
+        [source_guild_id, guild_id, user_id],
+    )
+
+    total, inserted_ids = result[0]["total"], result[0]["inserted_ids"]
+    if not inserted_ids:
+        return total, []
+    return total, await AutoResponseModel.filter(id__in=inserted_ids)
@@ -1,71 +1,360 @@
+import asyncio
+import logging
 import os
 import pickle
 import random
-from typing import Dict, List
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import aiofiles
+import aiohttp
 import discord
 from asyncpraw import Reddit
-from asyncpraw.models import Submission
+from cachetools import LRUCache
 from discord.ext import commands, tasks
 
 from config.reddit import reddit_config
 
+ALLOWED_EXTENSIONS = (".gif", ".png", ".jpg", ".jpeg")
 
-class RedditPostCacher:
-    def __init__(self, subreddit_names: List[str], cache_location):
-        self.subreddit_names = subreddit_names
-
-        # Asyncpraw client configuration
-        self.reddit = Reddit(
-            client_id=reddit_config.id,
-            client_secret=reddit_config.secret,
-            user_agent="Peace Bot",
+
+def post_embed(title: str, permalink: str, url: str) -> Dict:
+    """The embed of a post, as a dict for `discord.Embed.from_dict`"""
+    return {
+        "description": f"**[{title}](https://new.reddit.com{permalink})**",
+        "color": discord.Color.dark_purple().value,
+        "image": {"url": url},
+    }
+
+
+class SubredditPool:
+    """
+    Posts of a subreddit stored as parallel tuples of their fields,
+    so that picking a random post is a single index
+    """
+
+    __slots__ = (
+        "urls",
+        "titles",
+        "permalinks",
+        "seen",
+        "sizes",
+        "content_types",
+        "embeds",
+    )
+
+    def __init__(self, posts: Iterable[Dict] = ()):
+        posts = list(posts)
+        self.urls = tuple(post["url"] for post in posts)
+        self.titles = tuple(post["title"] for post in posts)
+        self.permalinks = tuple(post["permalink"] for post in posts)
+        # When each post was last fetched, posts gone from the listing age out
+        self.seen = tuple(post.get("seen", 0.0) for post in posts)
+        # Image metadata from validating the urls, `None` for unvalidated snapshots
+        self.sizes = tuple(post.get("size") for post in posts)
+        self.content_types = tuple(post.get("content_type") for post in posts)
+        self.embeds = tuple(
+            post.get("embed")
+            or post_embed(post["title"], post["permalink"], post["url"])
+            for post in posts
         )
 
-        # Determine the file name to save the caches to
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def __getitem__(self, index: int) -> Dict:
+        return {
+            "url": self.urls[index],
+            "title": self.titles[index],
+            "permalink": self.permalinks[index],
+            "seen": self.seen[index],
+            "size": self.sizes[index],
+            "content_type": self.content_types[index],
+            "embed": self.embeds[index],
+        }
+
+    def posts(self) -> List[Dict]:
+        return [self[index] for index in range(len(self))]
+
+    def merge(
+        self, posts: List[Dict], max_age: float, max_size: int
+    ) -> "SubredditPool":
+        """
+        Returns a pool of the fetched posts followed by the previous posts
+        which weren't fetched again, dropping those not seen for `max_age` seconds
+        """
+        merged = {post["permalink"]: post for post in posts}
+        oldest = time.time() - max_age
+
+        for post in self.posts():
+            if len(merged) >= max_size:
+                break
+            if post["seen"] >= oldest:
+                merged.setdefault(post["permalink"], post)
+
+        return SubredditPool(list(merged.values())[:max_size])
+
+
+class ShuffleDeck:
+    """
+    A shuffled order of a pool's indices, walked one post at a time,
+    so that a channel sees every post of the pool before any repeats
+    """
+
+    __slots__ = ("pool", "order", "position")
+
+    def __init__(self, pool: SubredditPool):
+        self.pool = pool
+        self.order = array("I", range(len(pool)))
+        self.position = 0
+        random.shuffle(self.order)
+
+    def draw(self) -> int:
+        if self.position >= len(self.order):
+            last = self.order[-1]
+            random.shuffle(self.order)
+            # Avoids repeating the last post across the reshuffle
+            if len(self.order) > 1 and self.order[0] == last:
+                self.order[0], self.order[-1] = self.order[-1], self.order[0]
+            self.position = 0
+
+        index = self.order[self.position]
+        self.position += 1
+        return index
+
+
+class RedditPostCacher:
+    """
+    Owns the reddit client and the post pools for every cog,
+    cogs register the subreddits they need and the refreshes are scheduled here.
+    It lives on the bot, so reloading a cog doesn't recreate the client or the loop.
+    """
+
+    def __init__(
+        self,
+        cache_location: str = "cache/Reddit.pickle",
+        concurrency: int = 4,
+        max_age: float = 6 * 60 * 60,
+        max_pool_size: int = 200,
+        refresh_interval: float = 30 * 60,
+        refresh_jitter: float = 5 * 60,
+        max_decks: int = 1000,
+        validation_concurrency: int = 10,
+        max_image_size: int = 8 * 1024 * 1024,
+    ):
+        self.pools: Dict[str, SubredditPool] = {}
+        # (channel id, subreddit) -> deck over the subreddit's pool
+        self._decks: LRUCache = LRUCache(max_decks)
+
+        self.max_age = max_age
+        self.max_pool_size = max_pool_size
+        self._refresh_semaphore = asyncio.Semaphore(concurrency)
+
+        # Subreddit -> time its next refresh is due
+        self.refresh_interval = refresh_interval
+        self.refresh_jitter = refresh_jitter
+        self._next_refresh: Dict[str, float] = {}
+
+        # Seconds the last refresh of each subreddit took
+        self.refresh_durations: Dict[str, float] = {}
+        self.failed_refreshes = 0
+
+        # Image urls are checked with HEAD requests before their posts are pooled
+        self.max_image_size = max_image_size
+        self._validation_semaphore = asyncio.Semaphore(validation_concurrency)
+        # Urls which can never be embedded, so that they aren't requested every refresh
+        self._rejected_urls: LRUCache = LRUCache(5000)
+        self.dropped_posts = 0
+
+        # Created on the first refresh, so that they're bound to the running loop.
+        # The reddit client makes its requests through the same session.
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.reddit: Optional[Reddit] = None
+
+        # Snapshot of the pools, only read to warm-start before the first refresh
         self.file_path = cache_location
 
-    @tasks.loop(minutes=30)
-    async def cache_posts(self):
-        subreddits = [
-            await self.reddit.subreddit(subreddit) for subreddit in self.subreddit_names
+    @property
+    def subreddit_names(self) -> List[str]:
+        return list(self._next_refresh)
+
+    def register(self, subreddit_names: Iterable[str]) -> None:
+        """Schedules the subreddits for refreshing, new ones are refreshed right away"""
+        now = time.time()
+        for subreddit_name in subreddit_names:
+            self._next_refresh.setdefault(subreddit_name, now)
+
+    @property
+    def post_count(self) -> int:
+        return sum(len(pool) for pool in self.pools.values())
+
+    @property
+    def pool_sizes(self) -> Dict[str, int]:
+        return {subreddit: len(pool) for subreddit, pool in self.pools.items()}
+
+    async def load_snapshot(self) -> None:
+        try:
+            async with aiofiles.open(self.file_path, mode="rb") as f:
+                snapshot = pickle.loads(await f.read())
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return
+
+        for subreddit, posts in snapshot.items():
+            self.pools.setdefault(subreddit, SubredditPool(posts))
+
+    async def save_snapshot(self) -> None:
+        snapshot = {subreddit: pool.posts() for subreddit, pool in self.pools.items()}
+
+        # Written next to the snapshot and swapped in, so it is never read half-written
+        temp_path = f"{self.file_path}.tmp"
+        async with aiofiles.open(temp_path, mode="wb+") as f:
+            await f.write(pickle.dumps(snapshot))
+        os.replace(temp_path, self.file_path)
+
+    @tasks.loop(minutes=1)
+    async def refresh_loop(self):
+        now = time.time()
+        due = [
+            subreddit_name
+            for subreddit_name, due_at in self._next_refresh.items()
+            if due_at <= now
         ]
-        data_to_dump = dict()
-        for subreddit in subreddits:
-            await subreddit.load()
-
-            posts = [
-                {
-                    "url": post.url,
-                    "title": post.title,
-                    "permalink": post.permalink,
-                }
-                async for post in subreddit.hot(limit=50)
-            ]
-
-            allowed_extensions = (".gif", ".png", ".jpg", ".jpeg")
-            posts = list(
-                filter(
-                    lambda i: any(
-                        (i.get("url").endswith(e) for e in allowed_extensions)
-                    ),
-                    posts,
+        if not due:
+            return
+
+        await asyncio.gather(
+            *(self.refresh_subreddit(subreddit_name) for subreddit_name in due)
+        )
+        await self.save_snapshot()
+
+    @refresh_loop.before_loop
+    async def before_refresh_loop(self):
+        await self.load_snapshot()
+
+    async def close(self) -> None:
+        self.refresh_loop.cancel()
+        if self.reddit:
+            await self.reddit.close()
+
+    async def refresh_subreddit(self, subreddit_name: str) -> None:
+        """Merges the hot posts of a subreddit into its pool, or keeps it on failure"""
+        async with self._refresh_semaphore:
+            start = time.perf_counter()
+            pool = self.pools.get(subreddit_name, SubredditPool())
+            try:
+                posts = await self._fetch_posts(subreddit_name)
+                posts = await self._validate_posts(posts, pool)
+            except Exception:
+                self.failed_refreshes += 1
+                logging.exception(f"Failed to refresh r/{subreddit_name}")
+                return
+            finally:
+                self.refresh_durations[subreddit_name] = time.perf_counter() - start
+                # Jittered, so that the subreddits drift apart over time
+                self._next_refresh[subreddit_name] = (
+                    time.time()
+                    + self.refresh_interval
+                    + random.uniform(0, self.refresh_jitter)
                 )
+
+        self.pools[subreddit_name] = pool.merge(posts, self.max_age, self.max_pool_size)
+
+    async def _fetch_posts(self, subreddit_name: str) -> List[Dict]:
+        if self.reddit is None:
+            self._session = aiohttp.ClientSession()
+            self.reddit = Reddit(
+                client_id=reddit_config.id,
+                client_secret=reddit_config.secret,
+                user_agent="Peace Bot",
+                requestor_kwargs={"session": self._session},
             )
-            data_to_dump[subreddit.display_name] = posts
 
-        async with aiofiles.open(self.file_path, mode="wb+") as f:
-            await f.write(pickle.dumps(data_to_dump))
+        subreddit = await self.reddit.subreddit(subreddit_name)
+        seen = time.time()
+
+        return [
+            {
+                "url": post.url,
+                "title": post.title,
+                "permalink": post.permalink,
+                "seen": seen,
+            }
+            async for post in subreddit.hot(limit=50)
+            if post.url.endswith(ALLOWED_EXTENSIONS)
+        ]
+
+    async def _validate_posts(
+        self, posts: List[Dict], pool: SubredditPool
+    ) -> List[Dict]:
+        """Adds the image metadata and embed to the posts, dropping broken images"""
+        # Posts which are already pooled were validated when they were added
+        pooled = {
+            permalink: index
+            for index, (permalink, size) in enumerate(zip(pool.permalinks, pool.sizes))
+            if size is not None
+        }
+
+        async def validate(post: Dict) -> Optional[Dict]:
+            index = pooled.get(post["permalink"])
+            if index is not None:
+                return {**pool[index], "seen": post["seen"]}
 
-    async def get_random_post(self, subreddit: str) -> Dict[str, str]:
-        Submission
-        """Fetches a post from the internal cache
+            if post["url"] in self._rejected_urls:
+                return None
+
+            try:
+                async with self._validation_semaphore:
+                    metadata = await self._image_metadata(post["url"])
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # Possibly temporary, so the url is checked again on the next refresh
+                self.dropped_posts += 1
+                return None
+            if metadata is None:
+                self._rejected_urls[post["url"]] = True
+                self.dropped_posts += 1
+                return None
+
+            post["size"], post["content_type"] = metadata
+            post["embed"] = post_embed(post["title"], post["permalink"], post["url"])
+            return post
+
+        validated = await asyncio.gather(*(validate(post) for post in posts))
+        return [post for post in validated if post is not None]
+
+    async def _image_metadata(self, url: str) -> Optional[Tuple[int, str]]:
+        """
+        The size and content type of an image, or `None` if it can't ever be embedded.
+        Raises `aiohttp.ClientError`/`asyncio.TimeoutError` if it couldn't be checked.
+        """
+        async with self._session.head(
+            url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=10)
+        ) as r:
+            if r.status in (404, 410):
+                return None
+            # Rate limits and server errors among others
+            r.raise_for_status()
+            content_type = r.headers.get("Content-Type", "")
+            try:
+                size = int(r.headers.get("Content-Length", 0))
+            except ValueError:
+                return None
+
+        if not content_type.startswith("image/") or size > self.max_image_size:
+            return None
+        return size, content_type
+
+    def get_random_post(
+        self, subreddit: str, channel_id: Optional[int] = None
+    ) -> Dict[str, str]:
+        """Picks a post from the in-memory pools
 
         Parameters
         ----------
         subreddit : str
             The name of the subreddit to fetch from
+        channel_id : Optional[int]
+            The channel whose deck to draw from, picks independently if not given
 
         Returns
         -------
@@ -77,15 +366,21 @@ class RedditPostCacher:
         ValueError
             The subreddit was not in the internal cache
         """
-        async with aiofiles.open(self.file_path, mode="rb") as f:
-            cache = pickle.loads(await f.read())
-            try:
-                subreddit = cache[subreddit]
-            except KeyError as e:
-                raise ValueError("Subreddit not in cache!") from e
-            else:
-                random_post = random.choice(subreddit)
-                return random_post
+        pool = self.pools.get(subreddit)
+        if not pool:
+            raise ValueError("Subreddit not in cache!")
+
+        if channel_id is None:
+            return pool[random.randrange(len(pool))]
+
+        key = (channel_id, subreddit)
+        deck = self._decks.get(key)
+        # Refreshing replaces the pool, the deck is only rebuilt once it's drawn from
+        if deck is None or deck.pool is not pool:
+            deck = ShuffleDeck(pool)
+            self._decks[key] = deck
+
+        return pool[deck.draw()]
 
     async def reddit_sender(self, ctx: commands.Context, subrd: str):
         """Fetches from reddit and sends results
@@ -99,17 +394,9 @@ class RedditPostCacher:
         title : str
                 The title to use in the embed
         """
-        # Gets the data from reddit!
-        submission = await self.get_random_post(subrd)
-
-        # Sends the embed!
-        embed = discord.Embed(
-            description="**[{}](https://new.reddit.com{})**".format(
-                submission.get("title"), submission.get("permalink")
-            ),
-            colour=discord.Color.dark_purple(),
-        )
-        discord.Member
-        embed.set_image(url=submission.get("url"))
+        submission = self.get_random_post(subrd, ctx.channel.id)
+
+        # The embed is prepared when the post is pooled, only the footer is per request
+        embed = discord.Embed.from_dict(submission["embed"])
         embed.set_footer(text=f"Requested: {ctx.author.name}")
         await ctx.reply(embed=embed)
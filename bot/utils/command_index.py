@@ -0,0 +1,87 @@
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+from uuid import UUID
+
+from models import CommandModel, GuildModel
+
+# Channel bucket for records which apply to every channel in the guild
+ALL_CHANNELS = 0
+
+IndexKey = Tuple[int, str, bool]
+
+
+class CommandIndex:
+    """
+    Compiled lookup of the disabled commands/cogs of a guild,
+    built from its `CommandModel` records.
+    A channel's own record overrides the guild's `ALL_CHANNELS` one.
+    """
+
+    def __init__(self, records: Iterable[CommandModel] = ()):
+        # Record id -> key and state it was indexed under, so it can be re-indexed
+        self._records: Dict[UUID, Tuple[IndexKey, bool]] = {}
+        self._disabled: Counter = Counter()
+        self._enabled: Counter = Counter()
+
+        for record in records:
+            self.update(record)
+
+    @staticmethod
+    def _key(record: CommandModel) -> IndexKey:
+        return (record.channel, record.name.lower(), record.is_cog)
+
+    def update(self, record: CommandModel) -> None:
+        """Adds a new record to the index or re-indexes a changed one"""
+        self.remove(record)
+
+        key = self._key(record)
+        self._records[record.id] = (key, record.enabled)
+        (self._enabled if record.enabled else self._disabled)[key] += 1
+
+    def remove(self, record: CommandModel) -> None:
+        indexed = self._records.pop(record.id, None)
+        if indexed is None:
+            return
+
+        key, enabled = indexed
+        counter = self._enabled if enabled else self._disabled
+        counter[key] -= 1
+        if counter[key] <= 0:
+            del counter[key]
+
+    def _is_disabled(self, channel_id: int, name: str, is_cog: bool) -> bool:
+        key = (channel_id, name.lower(), is_cog)
+        if key in self._disabled:
+            return True
+        if key in self._enabled:
+            return False
+        return (ALL_CHANNELS, *key[1:]) in self._disabled
+
+    def command_disabled(self, channel_id: int, command_name: str) -> bool:
+        return self._is_disabled(channel_id, command_name, False)
+
+    def cog_disabled(self, channel_id: int, cog_name: str) -> bool:
+        return self._is_disabled(channel_id, cog_name, True)
+
+
+async def toggle_all_channels(
+    guild: GuildModel, name: str, is_cog: bool, toggle: bool
+) -> List[CommandModel]:
+    """
+    Disables a command/cog with an `ALL_CHANNELS` record, or enables it in every
+    channel. The channel records are toggled too, so that a channel enabled
+    before doesn't override the new state. Returns the changed records.
+    """
+    if not toggle:
+        await CommandModel.get_or_create(
+            guild=guild, name=name, channel=ALL_CHANNELS, is_cog=is_cog
+        )
+
+    query = CommandModel.filter(
+        guild=guild, name=name, is_cog=is_cog, enabled=not toggle
+    )
+    records = await query
+    await query.update(enabled=toggle)
+    for record in records:
+        record.enabled = toggle
+    return records
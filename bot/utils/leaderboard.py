@@ -0,0 +1,130 @@
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+Entry = Tuple[int, int]
+
+
+class _BucketedList:
+    """
+    Sorted list split into buckets of at most `2 * load` items, like
+    `sortedcontainers.SortedList`. Adding and removing only shifts the items of a
+    single bucket instead of the whole list, which is what made big guilds slow.
+    """
+
+    def __init__(self, items: Iterable[Entry] = (), load: int = 500):
+        self._load = load
+        items = sorted(items)
+        self._buckets: List[List[Entry]] = [
+            items[start : start + load] for start in range(0, len(items), load)
+        ]
+        # Last item of each bucket, to binary search for the bucket of an item
+        self._maxes: List[Entry] = [bucket[-1] for bucket in self._buckets]
+        self._len = len(items)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator[Entry]:
+        for bucket in self._buckets:
+            yield from bucket
+
+    def add(self, item: Entry) -> None:
+        if not self._buckets:
+            self._buckets.append([item])
+            self._maxes.append(item)
+            self._len += 1
+            return
+
+        index = min(bisect_left(self._maxes, item), len(self._buckets) - 1)
+        bucket = self._buckets[index]
+        insort(bucket, item)
+        self._maxes[index] = bucket[-1]
+        self._len += 1
+
+        if len(bucket) > 2 * self._load:
+            self._buckets.insert(index + 1, bucket[self._load :])
+            del bucket[self._load :]
+            self._maxes.insert(index, bucket[-1])
+
+    def remove(self, item: Entry) -> None:
+        index = bisect_left(self._maxes, item)
+        bucket = self._buckets[index]
+        del bucket[bisect_left(bucket, item)]
+        self._len -= 1
+
+        if bucket:
+            self._maxes[index] = bucket[-1]
+        else:
+            del self._buckets[index]
+            del self._maxes[index]
+
+    def count_before(self, item: Entry) -> int:
+        """Number of items lower than `item`"""
+        index = bisect_left(self._maxes, item)
+        if index == len(self._buckets):
+            return self._len
+
+        before = sum(len(bucket) for bucket in self._buckets[:index])
+        return before + bisect_left(self._buckets[index], item)
+
+    def slice(self, start: int, stop: int) -> List[Entry]:
+        items: List[Entry] = []
+        for bucket in self._buckets:
+            if stop <= 0:
+                break
+            if start < len(bucket):
+                items.extend(bucket[start:stop])
+            start = max(start - len(bucket), 0)
+            stop -= len(bucket)
+        return items
+
+
+class GuildLeaderboard:
+    """
+    Members of a guild ordered by xp, kept sorted as their xp changes.
+    Updates only shift a bucket of the ranking, positions are binary searches
+    over the buckets and pages are slices of them.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[int, int]] = ()):
+        self._xp: Dict[int, int] = dict(entries)
+        # Sorted (-xp, user_id) pairs, so that the highest xp comes first
+        self._ranking = _BucketedList(
+            (-xp, user_id) for user_id, xp in self._xp.items()
+        )
+
+    def __len__(self) -> int:
+        return len(self._ranking)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._xp
+
+    def update(self, user_id: int, xp: int) -> None:
+        old_xp = self._xp.get(user_id)
+        if old_xp == xp:
+            return
+
+        if old_xp is not None:
+            self._ranking.remove((-old_xp, user_id))
+
+        self._ranking.add((-xp, user_id))
+        self._xp[user_id] = xp
+
+    def remove(self, user_id: int) -> None:
+        xp = self._xp.pop(user_id, None)
+        if xp is not None:
+            self._ranking.remove((-xp, user_id))
+
+    def position(self, user_id: int) -> Optional[int]:
+        """1 + the number of members with more xp, or `None` if the user is unranked"""
+        xp = self._xp.get(user_id)
+        if xp is None:
+            return None
+        return self._ranking.count_before((-xp,)) + 1
+
+    def top(self, count: int, offset: int = 0) -> List[Tuple[int, int]]:
+        """Returns a page of (user_id, xp) pairs, highest xp first"""
+        return [
+            (user_id, -negative_xp)
+            for negative_xp, user_id in self._ranking.slice(offset, offset + count)
+        ]
@@ -1,16 +1,27 @@
 import asyncio
+import logging
+import math
 import random
+import time
 from dataclasses import dataclass
-from typing import List, Mapping, Tuple, Union
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Mapping, Tuple, Union
 
-import aiohttp
 import discord
-from cachetools import LRUCache
+from cachetools import LRUCache, TTLCache
 from discord.ext import commands, tasks
+from tortoise import Tortoise
 
 from bot.bot import PeaceBot
+from bot.utils.command_index import toggle_all_channels
+from bot.utils.leaderboard import GuildLeaderboard
+from bot.utils.metrics import LatencyRecorder
+from bot.utils.model_cache import ModelCache
+from bot.utils.role_rewards import RoleRewardQueue, RoleRewards
 from models import CommandModel, GuildModel, LevelingUserModel, UserModel
 
+MEE6_PAGE_SIZE = 1000
+MEE6_MAX_RETRIES = 5
+
 
 @dataclass
 class UserRank:
@@ -24,6 +35,17 @@ class UserRank:
     image_banner: str
 
 
+@dataclass
+class Mee6ImportProgress:
+    pages: int = 0
+    players: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def throughput(self) -> float:
+        return self.players / self.elapsed if self.elapsed else 0.0
+
+
 class UserNotRanked(commands.CommandError):
     def __str__(self):
         return "User Hasn't Been Ranked Yet!"
@@ -34,20 +56,57 @@ class Mee6DataNotFound(commands.CommandError):
         return "Mee6 data for this guild not found!"
 
 
+class Mee6RateLimited(commands.CommandError):
+    def __str__(self):
+        return "Mee6 is rate limiting the import, try again later!"
+
+
+class WriteBackCache(LRUCache):
+    """LRU cache which reports evicted items instead of silently dropping them"""
+
+    def __init__(self, maxsize: int, on_evict: Callable[[Tuple, object], None]):
+        super().__init__(maxsize)
+        self._on_evict = on_evict
+
+    def popitem(self):
+        key, value = super().popitem()
+        self._on_evict(key, value)
+        return key, value
+
+
 class LevelingHandler:
-    def __init__(self, bot: PeaceBot):
+    def __init__(
+        self, bot: PeaceBot, flush_interval: float = 60, max_dirty: int = 5000
+    ):
         self._bot = bot
         self._user_cache: Mapping[
             Tuple[discord.Guild.id, discord.Member.id], LevelingUserModel
-        ] = LRUCache(1000)
+        ] = WriteBackCache(1000, self._on_cache_evict)
 
-        # This cache is for cross-checking the user models for reducing db queries
-        # Using this cache checking takes double the memory but reduces processing
-        self._user_check_cache_xp: Mapping[
-            Tuple[discord.Guild.id, discord.Member.id], int
-        ] = LRUCache(1000)
+        # Models with changes which haven't been written to the db yet
+        # These are kept here even after being evicted from the cache until flushed
+        self._dirty: Dict[
+            Tuple[discord.Guild.id, discord.Member.id], LevelingUserModel
+        ] = {}
+        self._flush_lock = asyncio.Lock()
+        # Unflushed models past which evictions flush early instead of waiting
+        self.max_dirty = max_dirty
+
+        # Sorted xp leaderboards, loaded on first access and rebuilt from the db
+        # once they expire so that they can't drift away from it
+        self._leaderboards = ModelCache(TTLCache(maxsize=100, ttl=3600))
+
+        # Compiled level -> role rewards of each guild and the queue applying them
+        self._role_rewards: Mapping[discord.Guild.id, RoleRewards] = LRUCache(1000)
+        self.role_reward_queue = RoleRewardQueue(bot)
+
+        # Flush stats, for tuning the flush interval
+        self.flush_latency = LatencyRecorder()
+        self.last_flush_size = 0
+        self.flushed_rows = 0
 
         # Starts bulk updating the db from cache
+        self.bulk_update_db.change_interval(seconds=flush_interval)
         self.bulk_update_db.start()
 
     @property
@@ -59,31 +118,14 @@ class LevelingHandler:
         self._user_cache = cache
 
     async def get_guild(self, guild_id: int) -> GuildModel:
-        guild_model = self._bot.guilds_cache.get(guild_id)
-
-        if not guild_model:
-            await asyncio.sleep(2)
-            guild_model = self._bot.guilds_cache.get(guild_id)
-
-            if not guild_model:
-                guild_model = await GuildModel.get(id=guild_id)
-
-        return guild_model
+        return await self._bot.get_guild_model(guild_id)
 
     async def get_user(self, user_id: int) -> UserModel:
-        user_model = self._bot.users_cache.get(user_id)
-
-        if not user_model:
-            await asyncio.sleep(2)
-            user_model = self._bot.users_cache.get(user_id)
-
-            if not user_model:
-                user_model, _ = await UserModel.get_or_create(id=user_id)
-
-        return user_model
+        return await self._bot.get_user_model(user_id)
 
     async def get_leveling_user(self, guild_id: int, user_id: int) -> LevelingUserModel:
-        leveling_user_model = self._user_cache.get((guild_id, user_id))
+        key = (guild_id, user_id)
+        leveling_user_model = self._user_cache.get(key) or self._dirty.get(key)
 
         if not leveling_user_model:
             user_model = await self.get_user(user_id)
@@ -96,33 +138,68 @@ class LevelingHandler:
         return leveling_user_model
 
     def required_xp_for_level(self, level: int) -> int:
-        return (50 * (level ** 2)) + (100 * level)
+        return (50 * (level**2)) + (100 * level)
+
+    @staticmethod
+    def level_from_xp(xp: int) -> int:
+        """
+        The lowest level whose required xp is more than `xp`.
+        Solves `50L² + 100L > xp` for the lowest L, which is `isqrt(xp // 50 + 1)`
+        """
+        if xp < 0:
+            return 0
+        return math.isqrt((xp + 50) // 50)
 
-    async def level_up_handler(self, user: LevelingUserModel) -> None:
-        await user.save()
-        await self.role_rewards_handler(user)
+    @classmethod
+    def levels_from_xp(cls, xps: Iterable[int]) -> List[int]:
+        return [cls.level_from_xp(xp) for xp in xps]
 
-        self._bot.dispatch("user_level_up", user)
-        self._user_cache[(user.guild_id, user.user_id)] = user
+    async def level_up_handler(self, user: LevelingUserModel, old_level: int) -> None:
+        self.update_leveling_cache(user)
+        await self.role_rewards_handler(user, old_level)
+
+        self._bot.dispatch("user_level_up", user, old_level)
 
     def update_leveling_cache(self, model: LevelingUserModel) -> None:
-        self._user_cache[(model.guild_id, model.user_id)] = model
+        key = (model.guild_id, model.user_id)
+        self._user_cache[key] = model
+        self._dirty[key] = model
+        self.update_leaderboard(model)
+
+    def update_leaderboard(self, model: LevelingUserModel) -> None:
+        leaderboard = self._leaderboards.get(model.guild_id)
+        if leaderboard is not None:
+            leaderboard.update(model.user_id, model.xp)
+
+    async def get_leaderboard(self, guild_id: int) -> GuildLeaderboard:
+        async def load_leaderboard() -> GuildLeaderboard:
+            leaderboard = GuildLeaderboard(
+                await LevelingUserModel.filter(guild_id=guild_id).values_list(
+                    "user_id", "xp"
+                )
+            )
+            # The db doesn't have the unflushed xp yet
+            for (model_guild_id, user_id), model in self._dirty.items():
+                if model_guild_id == guild_id:
+                    leaderboard.update(user_id, model.xp)
+            return leaderboard
+
+        return await self._leaderboards.get_or_load(guild_id, load_leaderboard)
+
+    def _on_cache_evict(self, key: Tuple[int, int], model: LevelingUserModel) -> None:
+        # Evicted models stay in `_dirty`, so this only flushes once too many pile up
+        if len(self._dirty) >= self.max_dirty and not self._flush_lock.locked():
+            asyncio.create_task(self.flush())
 
     async def get_user_level(self, user_model: LevelingUserModel) -> int:
-        while True:
-            if user_model.xp < self.required_xp_for_level(user_model.level):
-                break
-            user_model.level += 1
-            await self.level_up_handler(user_model)
-        return user_model.level
+        old_level = user_model.level
+        new_level = self.level_from_xp(user_model.xp)
 
-    async def get_user_level_from_xp(self, xp: int) -> int:
-        level = 0
-        while True:
-            if xp < self.required_xp_for_level(level):
-                break
-            level += 1
-        return level
+        # A jump of multiple levels is handled as a single level up
+        if new_level > old_level:
+            user_model.level = new_level
+            await self.level_up_handler(user_model, old_level)
+        return user_model.level
 
     async def update_user(
         self, user: LevelingUserModel, guild: GuildModel
@@ -143,14 +220,8 @@ class LevelingHandler:
             return False
 
         commands_cache = await self._bot.get_commands_cache(message.guild.id)
-        check = (
-            lambda model: model.name == "leveling-system"
-            and not model.enabled
-            and (model.channel == "all" or model.channel == message.channel.id)
-        )
-        valid = [model for model in commands_cache if check(model)]
 
-        if valid:
+        if commands_cache.command_disabled(message.channel.id, "leveling-system"):
             return False
         return True
 
@@ -175,19 +246,33 @@ class LevelingHandler:
     async def get_user_rank(self, member: discord.Member) -> UserRank:
         guild_model = await self.get_guild(member.guild.id)
 
-        leveling_user_models: List[LevelingUserModel] = await LevelingUserModel.filter(
-            guild=guild_model
-        ).order_by("xp")
-        leveling_user_models.reverse()
+        key = (member.guild.id, member.id)
+        user_model = (
+            self._user_cache.get(key)
+            or self._dirty.get(key)
+            or await LevelingUserModel.get_or_none(
+                guild_id=member.guild.id, user_id=member.id
+            )
+        )
 
-        try:
-            user_model = list(
-                filter(lambda model: model.user_id == member.id, leveling_user_models)
-            )[0]
-        except IndexError:
+        if not user_model:
             raise UserNotRanked()
 
-        index = leveling_user_models.index(user_model) + 1
+        leaderboard = self._leaderboards.get(member.guild.id)
+        if leaderboard is not None:
+            index = leaderboard.position(member.id)
+        else:
+            # Cold guilds are ranked with an indexed count instead of loading
+            # the whole leaderboard for a single position
+            index = (
+                await LevelingUserModel.filter(
+                    guild_id=member.guild.id, xp__gt=user_model.xp
+                ).count()
+                + 1
+            )
+
+        if not index:
+            raise UserNotRanked()
 
         prev_level_xp = self.required_xp_for_level(user_model.level - 1)
         new_level_xp = self.required_xp_for_level(user_model.level)
@@ -209,21 +294,104 @@ class LevelingHandler:
         )
         return user_rank
 
-    async def import_from_mee6(self, guild_id: int) -> None:
-        async with aiohttp.ClientSession() as cs:
-            async with cs.get(
-                f"https://mee6.xyz/api/plugins/levels/leaderboard/{guild_id}?limit=999&page=0"
+    async def import_from_mee6(
+        self, guild_id: int
+    ) -> AsyncIterator[Mee6ImportProgress]:
+        """Imports the guild's Mee6 leaderboard page by page, yielding the progress"""
+        start = time.perf_counter()
+        progress = Mee6ImportProgress()
+        imported: List[Tuple[int, int]] = []
+
+        # The guild has to exist in the db before its leveling rows
+        await self.get_guild(guild_id)
+
+        page = 0
+        while True:
+            players = await self._fetch_mee6_page(guild_id, page)
+            if not players:
+                break
+
+            levels = self.levels_from_xp(player.get("xp") for player in players)
+            # A flush running meanwhile would write back the cached pre-import xp
+            async with self._flush_lock:
+                await self._bulk_upsert(guild_id, players, levels)
+                self._forget_imported(guild_id, players)
+
+            imported.extend(
+                (int(player.get("id")), level) for player, level in zip(players, levels)
+            )
+            page += 1
+            progress.pages = page
+            progress.players += len(players)
+            progress.elapsed = time.perf_counter() - start
+            yield progress
+
+            if len(players) < MEE6_PAGE_SIZE:
+                break
+
+        if not progress.players:
+            raise Mee6DataNotFound()
+
+        self._leaderboards.pop(guild_id)
+        asyncio.create_task(self.mee6_role_rewards_handler(guild_id, imported))
+
+    async def _fetch_mee6_page(self, guild_id: int, page: int) -> List[dict]:
+        for _ in range(MEE6_MAX_RETRIES + 1):
+            async with self._bot.session.get(
+                f"https://mee6.xyz/api/plugins/levels/leaderboard/{guild_id}",
+                params={"limit": MEE6_PAGE_SIZE, "page": page},
             ) as r:
                 if r.status == 404:
                     raise Mee6DataNotFound()
+                if r.status == 429:
+                    await asyncio.sleep(float(r.headers.get("Retry-After", 1)))
+                    continue
                 data = await r.json()
+                return data.get("players")
+
+        raise Mee6RateLimited()
+
+    async def _bulk_upsert(
+        self, guild_id: int, players: List[dict], levels: List[int]
+    ) -> None:
+        """Upserts a page of Mee6 players (and their user rows) in a single query"""
+        table = LevelingUserModel._meta.db_table
+        users_table = UserModel._meta.db_table
+        connection = Tortoise.get_connection("default")
+        await connection.execute_query(
+            "WITH data AS ("
+            "SELECT * FROM unnest($2::bigint[], $3::bigint[], $4::int[], $5::int[]) "
+            "AS data(user_id, xp, level, messages)"
+            "), new_users AS ("
+            f'INSERT INTO "{users_table}" ("id") SELECT user_id FROM data '
+            'ON CONFLICT ("id") DO NOTHING'
+            "), updated AS ("
+            f'UPDATE "{table}" AS leveling '
+            'SET "xp" = data.xp, "level" = data.level, "messages" = data.messages '
+            'FROM data WHERE leveling."guild_id" = $1 '
+            'AND leveling."user_id" = data.user_id '
+            'RETURNING leveling."user_id"'
+            ") "
+            f'INSERT INTO "{table}" '
+            '("id", "guild_id", "user_id", "xp", "level", "messages") '
+            "SELECT gen_random_uuid(), $1, data.user_id, data.xp, data.level, "
+            "data.messages FROM data "
+            "WHERE data.user_id NOT IN (SELECT user_id FROM updated)",
+            [
+                guild_id,
+                [int(player.get("id")) for player in players],
+                [player.get("xp") for player in players],
+                levels,
+                [player.get("message_count") for player in players],
+            ],
+        )
 
-        members = [
-            self.update_db_from_other(guild_id, member)
-            for member in data.get("players")
-        ]
-        data = await asyncio.gather(*members)
-        await asyncio.create_task(self.mee6_role_rewards_handler(data))
+    def _forget_imported(self, guild_id: int, players: List[dict]) -> None:
+        # Cached models of imported users would overwrite the imported xp
+        for player in players:
+            key = (guild_id, int(player.get("id")))
+            self._user_cache.pop(key, None)
+            self._dirty.pop(key, None)
 
     async def leveling_toggle_handler(
         self,
@@ -231,8 +399,7 @@ class LevelingHandler:
         ctx: commands.Context,
         toggle: bool,
     ):
-        guild_model = self._bot.guilds_cache.get(ctx.guild.id)
-        _channels = ctx.guild.text_channels if isinstance(channels, str) else channels
+        guild_model = await self._bot.get_guild_model(ctx.guild.id)
 
         async def save_leveling_togle(channel):
             record, _ = await CommandModel.get_or_create(
@@ -242,90 +409,118 @@ class LevelingHandler:
             )
             record.enabled = toggle
             await record.save()
+            return record
 
-        tasks = [save_leveling_togle(channel) for channel in _channels]
-        asyncio.gather(*tasks)
+        if isinstance(channels, str):
+            records = await toggle_all_channels(
+                guild_model, "leveling-system", False, toggle
+            )
+        else:
+            tasks = [save_leveling_togle(channel) for channel in channels]
+            records = await asyncio.gather(*tasks)
+        self._bot.update_commands_cache(ctx.guild.id, records)
 
         channels_str = (
             "`all`"
             if isinstance(channels, str)
-            else ", ".join([channel.mention for channel in _channels])
+            else ", ".join([channel.mention for channel in channels])
         )
         toggle_str = "enabled" if toggle else "disabled"
 
         await ctx.reply(f"Leveling has been {toggle_str} for channel {channels_str}")
 
-    async def mee6_role_rewards_handler(self, user_models: List[LevelingUserModel]):
-        for user in user_models:
-            asyncio.create_task(self.role_rewards_handler(user, mee6_import=True))
-            await asyncio.sleep(0.1)
-
-    async def role_rewards_handler(
-        self, user_model: LevelingUserModel, mee6_import: bool = False
-    ):
-        guild: discord.Guild = self._bot.get_guild(user_model.guild_id)
-
-        try:
-            user: discord.Member = await guild.fetch_member(user_model.user_id)
-        except discord.HTTPException:
-            return
-
-        guild_model = await self._bot.get_guild_model(user_model.guild_id)
-
-        if not guild_model.xp_role_rewards:
+    async def mee6_role_rewards_handler(
+        self, guild_id: int, imported: List[Tuple[int, int]]
+    ) -> None:
+        role_rewards = await self.get_role_rewards(guild_id)
+        guild = self._bot.get_guild(guild_id)
+        if not role_rewards or guild is None:
             return
 
-        if str(user_model.level) not in guild_model.xp_role_rewards.keys():
-            return
+        for user_id, level in imported:
+            # Most Mee6 players have left the guild, they would only be fetched to 404
+            if guild.get_member(user_id) is None:
+                continue
+            role_ids = role_rewards.between(0, level)
+            if role_ids:
+                await self.role_reward_queue.add(guild_id, user_id, role_ids)
 
-        if mee6_import:
-            roles = [
-                guild.get_role(guild_model.xp_role_rewards.get(str(level)))
-                for level in guild_model.xp_role_rewards.keys()
-                if int(user_model.level) >= int(level)
-            ]
-        else:
-            roles = [
-                guild.get_role(guild_model.xp_role_rewards.get(str(user_model.level)))
-            ]
+    async def get_role_rewards(self, guild_id: int) -> RoleRewards:
+        role_rewards = self._role_rewards.get(guild_id)
 
-        if not roles:
-            return
+        if role_rewards is None:
+            guild_model = await self._bot.get_guild_model(guild_id)
+            role_rewards = RoleRewards(guild_model.xp_role_rewards)
+            self._role_rewards[guild_id] = role_rewards
 
-        await user.add_roles(*roles, reason=f"Level up to level {user_model.level}")
+        return role_rewards
 
-    async def update_db_from_other(self, guild_id: int, member: dict) -> None:
-        user = await self.get_leveling_user(guild_id, member.get("id"))
-        user_level = await self.get_user_level_from_xp(member.get("xp"))
+    def invalidate_role_rewards(self, guild_id: int) -> None:
+        self._role_rewards.pop(guild_id, None)
 
-        user.messages = member.get("message_count")
-        user.xp = member.get("xp")
-        user.level = user_level
+    async def role_rewards_handler(self, user_model: LevelingUserModel, old_level: int):
+        role_rewards = await self.get_role_rewards(user_model.guild_id)
 
-        asyncio.create_task(self.save_in_db(user))
+        # Rewards for every level passed since the old level
+        role_ids = role_rewards.between(old_level, user_model.level)
+        if not role_ids:
+            return
 
-        self._user_cache[(user.guild_id, user.user_id)] = user
-        self._user_check_cache_xp[(user.guild_id, user.user_id)] = user.xp
-        return user
+        await self.role_reward_queue.add(
+            user_model.guild_id, user_model.user_id, role_ids
+        )
 
     @tasks.loop(minutes=1)
     async def bulk_update_db(self) -> None:
-        leveling_models = self._user_cache.values()
-        bulk_update_tasks = [
-            self.save_leveling_models(model) for model in leveling_models
-        ]
-        await asyncio.gather(*bulk_update_tasks)
+        await self.flush()
 
     @bulk_update_db.before_loop
     async def before_bulk_db_update(self) -> None:
         await self._bot.wait_until_ready()
 
-    async def save_leveling_models(self, model: LevelingUserModel) -> None:
-        check_cache_xp = self._user_check_cache_xp.get((model.guild_id, model.user_id))
-        if model.xp == check_cache_xp:
-            return
-        asyncio.create_task(self.save_in_db(model))
-        self._user_check_cache_xp[(model.guild_id, model.user_id)] = model.xp
+    async def flush(self) -> None:
+        """Writes all the dirty leveling models to the db in a single query"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+
+            dirty, self._dirty = self._dirty, {}
+            models = list(dirty.values())
+
+            try:
+                with self.flush_latency.time():
+                    await self._bulk_update(models)
+            except Exception:
+                # Models changed again since the snapshot are already marked dirty
+                for key, model in dirty.items():
+                    self._dirty.setdefault(key, model)
+                logging.exception("Failed to flush the leveling models")
+                return
+
+            # Leaderboards loaded while the flush was running read the old xp
+            for model in models:
+                self.update_leaderboard(model)
+
+            self.last_flush_size = len(models)
+            self.flushed_rows += len(models)
+            logging.info(
+                f"Flushed {len(models)} leveling models in "
+                f"{self.flush_latency.last * 1000:.2f}ms"
+            )
 
-    async def save_in_db(self, model: LevelingUserModel) -> None:
-        await model.save()
+    async def _bulk_update(self, models: List[LevelingUserModel]) -> None:
+        table = LevelingUserModel._meta.db_table
+        connection = Tortoise.get_connection("default")
+        await connection.execute_query(
+            f'UPDATE "{table}" AS leveling '
+            'SET "xp" = data.xp, "level" = data.level, "messages" = data.messages '
+            "FROM unnest($1::uuid[], $2::bigint[], $3::int[], $4::int[]) "
+            "AS data(id, xp, level, messages) "
+            'WHERE leveling."id" = data.id',
+            [
+                [model.id for model in models],
+                [model.xp for model in models],
+                [model.level for model in models],
+                [model.messages for model in models],
+            ],
+        )
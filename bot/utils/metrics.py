@@ -0,0 +1,47 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Iterator
+
+
+class LatencyRecorder:
+    """Keeps a bounded window of latency samples (in seconds)"""
+
+    def __init__(self, window: int = 1000):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(time.perf_counter() - start)
+
+    @property
+    def last(self) -> float:
+        return self._samples[-1] if self._samples else 0.0
+
+    @property
+    def average(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, pct: float) -> float:
+        if not self._samples:
+            return 0.0
+        samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(len(samples) * pct / 100))
+        return samples[index]
+
+    def __str__(self):
+        return (
+            f"p50 {self.percentile(50) * 1000:.2f}ms | "
+            f"p99 {self.percentile(99) * 1000:.2f}ms"
+        )
@@ -0,0 +1,76 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from cachetools import Cache
+
+_MISSING = object()
+
+
+class ModelCache:
+    """
+    Wraps a cachetools cache so that falsy values (like an empty list of
+    records) count as cached, and concurrent misses for the same key are
+    coalesced into a single load
+    """
+
+    def __init__(self, cache: Cache):
+        self._cache = cache
+        self._loading: Dict[Hashable, asyncio.Task] = {}
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def __getitem__(self, key: Hashable) -> Any:
+        return self._cache[key]
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        # A write wins over any load which is still in-flight for the key
+        self._loading.pop(key, None)
+        self._cache[key] = value
+
+    def __delitem__(self, key: Hashable) -> None:
+        self._loading.pop(key, None)
+        del self._cache[key]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._cache
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        return self._cache.get(key, default)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        self._loading.pop(key, None)
+        return self._cache.pop(key, default)
+
+    async def get_or_load(
+        self, key: Hashable, loader: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        value = self._cache.get(key, _MISSING)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, loader))
+            self._loading[key] = task
+
+        # Shielded so that one cancelled waiter doesn't cancel the load for the others
+        return await asyncio.shield(task)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        self.loads += 1
+        try:
+            value = await loader()
+            if self._loading.get(key) is asyncio.current_task():
+                self._cache[key] = value
+            return value
+        finally:
+            if self._loading.get(key) is asyncio.current_task():
+                del self._loading[key]
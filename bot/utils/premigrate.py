@@ -0,0 +1,40 @@
+"""
+Fixes to existing rows which have to be made before `aerich upgrade` can apply
+the schema of `models.py`, run with `python -m bot.utils.premigrate`
+"""
+from tortoise import Tortoise, run_async
+from tortoise.transactions import in_transaction
+
+from models import AutoResponseModel
+
+
+async def dedupe_autoresponses() -> int:
+    """
+    Keeps a single autoresponse per guild and trigger, so that the unique
+    constraint on them can be created. Enabled ones are kept over disabled ones.
+    Returns the number of deleted rows.
+    """
+    table = AutoResponseModel._meta.db_table
+
+    async with in_transaction() as connection:
+        deleted, _ = await connection.execute_query(
+            f'DELETE FROM "{table}" WHERE "id" IN ('
+            'SELECT "id" FROM ('
+            'SELECT "id", row_number() OVER ('
+            'PARTITION BY "guild_id", "trigger" ORDER BY "enabled" DESC, "id"'
+            f') AS duplicate FROM "{table}"'
+            ") AS ranked WHERE duplicate > 1)"
+        )
+    return deleted
+
+
+async def main() -> None:
+    from tortoise_config import tortoise_config
+
+    await Tortoise.init(tortoise_config)
+    deleted = await dedupe_autoresponses()
+    print(f"Deleted {deleted} duplicate autoresponses")
+
+
+if __name__ == "__main__":
+    run_async(main())
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from typing import List, Set, Tuple
+
+from cachetools import LRUCache
+from discord.ext import tasks
+from tortoise.transactions import in_transaction
+
+from bot.utils.metrics import LatencyRecorder
+from config.bot import bot_config
+from models import GuildModel, UserModel
+
+
+class RegistrationQueue:
+    """
+    Write-behind queue for registering unseen guilds and users in the db,
+    so that `on_message` never has to wait on a db round-trip
+    """
+
+    def __init__(self, batch_size: int = 500, seen_cache_size: int = 10000):
+        self.batch_size = batch_size
+
+        # Pairs which are already in the db (or queued), to avoid enqueuing them again
+        self._seen: LRUCache = LRUCache(seen_cache_size)
+        self._pending: Set[Tuple[int, int]] = set()
+        # The loop and the shutdown hook may both flush at the same time
+        self._flush_lock = asyncio.Lock()
+
+        # Counters
+        self.flush_latency = LatencyRecorder()
+        self.flushed_rows = 0
+        self.failed_flushes = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def enqueue(self, guild_id: int, user_id: int) -> None:
+        key = (guild_id, user_id)
+        if key in self._seen:
+            return
+        self._seen[key] = True
+        self._pending.add(key)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            while self._pending:
+                batch = [
+                    self._pending.pop()
+                    for _ in range(min(self.batch_size, len(self._pending)))
+                ]
+                try:
+                    with self.flush_latency.time():
+                        await self._insert_batch(batch)
+                except Exception:
+                    # Putting the batch back so that it is retried on the next flush
+                    self._pending.update(batch)
+                    self.failed_flushes += 1
+                    logging.exception("Failed to flush the registration queue")
+                    return
+                self.flushed_rows += len(batch)
+
+    @staticmethod
+    async def create_link_index() -> None:
+        """
+        Adds a unique index to the guild/user M2M table (which tortoise doesn't),
+        so that links can be inserted with `ON CONFLICT DO NOTHING`
+        """
+        users_field = GuildModel._meta.fields_map["users"]
+        through = users_field.through
+        guild_key, user_key = users_field.backward_key, users_field.forward_key
+
+        async with in_transaction() as connection:
+            # Duplicate links have to go before the index can be created
+            await connection.execute_query(
+                f'DELETE FROM "{through}" AS link USING "{through}" AS duplicate '
+                "WHERE link.ctid < duplicate.ctid "
+                f'AND link."{guild_key}" = duplicate."{guild_key}" '
+                f'AND link."{user_key}" = duplicate."{user_key}"'
+            )
+            await connection.execute_query(
+                f'CREATE UNIQUE INDEX IF NOT EXISTS "uid_{through}_link" '
+                f'ON "{through}" ("{guild_key}", "{user_key}")'
+            )
+
+    @tasks.loop(seconds=5)
+    async def flush_loop(self) -> None:
+        await self.flush()
+
+    async def _insert_batch(self, batch: List[Tuple[int, int]]) -> None:
+        guild_ids = list({guild_id for guild_id, _ in batch})
+        user_ids = list({user_id for _, user_id in batch})
+        link_guild_ids = [guild_id for guild_id, _ in batch]
+        link_user_ids = [user_id for _, user_id in batch]
+
+        users_field = GuildModel._meta.fields_map["users"]
+        guilds_table = GuildModel._meta.db_table
+        users_table = UserModel._meta.db_table
+
+        async with in_transaction() as connection:
+            await connection.execute_query(
+                f'INSERT INTO "{guilds_table}" ("id", "prefix", "xp_multiplier") '
+                "SELECT guild_id, $2, 1 FROM unnest($1::bigint[]) AS guild_id "
+                'ON CONFLICT ("id") DO NOTHING',
+                [guild_ids, bot_config.prefix],
+            )
+            await connection.execute_query(
+                f'INSERT INTO "{users_table}" ("id") '
+                "SELECT user_id FROM unnest($1::bigint[]) AS user_id "
+                'ON CONFLICT ("id") DO NOTHING',
+                [user_ids],
+            )
+            # Relies on the unique index from `create_link_index`
+            await connection.execute_query(
+                f'INSERT INTO "{users_field.through}" '
+                f'("{users_field.backward_key}", "{users_field.forward_key}") '
+                "SELECT link.guild_id, link.user_id "
+                "FROM unnest($1::bigint[], $2::bigint[]) AS link(guild_id, user_id) "
+                f'ON CONFLICT ("{users_field.backward_key}", '
+                f'"{users_field.forward_key}") DO NOTHING',
+                [link_guild_ids, link_user_ids],
+            )
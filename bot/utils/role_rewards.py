@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from bisect import bisect_right
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set
+
+import discord
+
+from bot.bot import PeaceBot
+
+
+class RoleRewards:
+    """A guild's level -> role rewards mapping compiled into sorted arrays"""
+
+    def __init__(self, xp_role_rewards: Optional[dict]):
+        rewards = sorted(
+            (int(level), role_id)
+            for (level, role_id) in (xp_role_rewards or {}).items()
+        )
+        self.levels: List[int] = [level for level, _ in rewards]
+        self.role_ids: List[int] = [role_id for _, role_id in rewards]
+
+    def __bool__(self) -> bool:
+        return bool(self.levels)
+
+    def between(self, old_level: int, new_level: int) -> List[int]:
+        """Ids of the roles for the levels in (old_level, new_level]"""
+        return self.role_ids[
+            bisect_right(self.levels, old_level) : bisect_right(self.levels, new_level)
+        ]
+
+
+@dataclass
+class _GuildRoleQueue:
+    queue: asyncio.Queue
+    # Member id -> role ids still to be added, so that multiple rewards are coalesced
+    pending: Dict[int, Set[int]] = field(default_factory=dict)
+
+
+class RoleRewardQueue:
+    """
+    Applies role rewards through one bounded queue per guild.
+    Rewards queued for a member who is already waiting are merged into one `add_roles` call.
+    """
+
+    def __init__(self, bot: PeaceBot, maxsize: int = 1000):
+        self._bot = bot
+        self.maxsize = maxsize
+        self._queues: Dict[int, _GuildRoleQueue] = {}
+
+    async def add(self, guild_id: int, member_id: int, role_ids: Iterable[int]) -> None:
+        guild_queue = self._queues.get(guild_id)
+        if guild_queue is None:
+            guild_queue = _GuildRoleQueue(asyncio.Queue(self.maxsize))
+            self._queues[guild_id] = guild_queue
+            asyncio.create_task(self._work(guild_id, guild_queue))
+
+        pending = guild_queue.pending.get(member_id)
+        if pending is not None:
+            pending.update(role_ids)
+            return
+
+        guild_queue.pending[member_id] = set(role_ids)
+        # Waits for space once the queue is full
+        await guild_queue.queue.put(member_id)
+
+    async def _work(self, guild_id: int, guild_queue: _GuildRoleQueue) -> None:
+        try:
+            while not guild_queue.queue.empty():
+                member_id = guild_queue.queue.get_nowait()
+                role_ids = guild_queue.pending.pop(member_id)
+                try:
+                    await self._apply(guild_id, member_id, role_ids)
+                except Exception:
+                    logging.exception(f"Failed to apply role rewards to {member_id}")
+        finally:
+            del self._queues[guild_id]
+
+    async def _apply(self, guild_id: int, member_id: int, role_ids: Set[int]) -> None:
+        guild: discord.Guild = self._bot.get_guild(guild_id)
+        if not guild:
+            return
+
+        member = await self._bot.get_or_fetch_member(guild, member_id)
+        if not member:
+            return
+
+        roles = [
+            role
+            for role in (guild.get_role(role_id) for role_id in role_ids)
+            if role and role not in member.roles
+        ]
+        if not roles:
+            return
+
+        try:
+            await member.add_roles(*roles, reason="Leveling role rewards")
+        except discord.HTTPException:
+            pass
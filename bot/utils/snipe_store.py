@@ -0,0 +1,175 @@
+import sys
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Deque, NamedTuple, Optional, Tuple
+
+import discord
+from cachetools import LRUCache
+
+
+class SnipeRecord(NamedTuple):
+    """What is kept of a deleted/edited message, instead of the message itself"""
+
+    author_id: int
+    author_name: str
+    avatar_url: str
+    content: str
+    created_at: datetime
+    edited_at: Optional[datetime] = None
+    # Content before the edit, for edit snipes
+    before: Optional[str] = None
+
+    @classmethod
+    def from_message(
+        cls, message: discord.Message, before: Optional[str] = None
+    ) -> "SnipeRecord":
+        return cls(
+            message.author.id,
+            message.author.display_name,
+            str(message.author.avatar_url),
+            message.content,
+            message.created_at,
+            message.edited_at,
+            before,
+        )
+
+    @property
+    def size(self) -> int:
+        """Approximate bytes held by the record"""
+        return (
+            _RECORD_OVERHEAD
+            + sys.getsizeof(self.author_name)
+            + sys.getsizeof(self.avatar_url)
+            + sys.getsizeof(self.content)
+            + (sys.getsizeof(self.before) if self.before is not None else 0)
+        )
+
+
+_RECORD_OVERHEAD = (
+    sys.getsizeof(tuple(range(len(SnipeRecord._fields))))
+    + sys.getsizeof(1 << 62)
+    + 2 * sys.getsizeof(datetime.utcnow())
+)
+
+
+class SnipeStore:
+    """
+    The last `history_size` records of each channel, in ring buffers by channel id.
+    Records expire `ttl` seconds after being added, and past `max_bytes`
+    the channels with the least recent records are evicted.
+    """
+
+    def __init__(
+        self,
+        history_size: int = 10,
+        max_bytes: int = 4 * 1024 * 1024,
+        ttl: float = 600,
+    ):
+        self.history_size = history_size
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # (time added, record) pairs, oldest first.
+        # Channels are ordered by their last record, so expired ones are at the front.
+        self._channels: "OrderedDict[int, Deque[Tuple[float, SnipeRecord]]]" = (
+            OrderedDict()
+        )
+
+        # Counters
+        self.size = 0
+        self.records = 0
+
+    def __str__(self) -> str:
+        return f"{self.records} messages | {self.size / 1024:.1f} KB"
+
+    def add(self, channel_id: int, record: SnipeRecord) -> None:
+        now = time.monotonic()
+        self.expire(now)
+
+        history = self._channels.get(channel_id)
+        if history is None:
+            history = deque(maxlen=self.history_size)
+            self._channels[channel_id] = history
+        else:
+            self._channels.move_to_end(channel_id)
+            self._expire(history, now)
+
+        if len(history) == self.history_size:
+            self._forget(history[0][1])
+        history.append((now, record))
+        self.size += record.size
+        self.records += 1
+
+        # Keeps the channel which was just added to, even if it's over the budget alone
+        while self.size > self.max_bytes and len(self._channels) > 1:
+            _, evicted = self._channels.popitem(last=False)
+            for _, evicted_record in evicted:
+                self._forget(evicted_record)
+
+    def _forget(self, record: SnipeRecord) -> None:
+        self.size -= record.size
+        self.records -= 1
+
+    def _expire(self, history: Deque[Tuple[float, SnipeRecord]], now: float) -> None:
+        while history and now - history[0][0] > self.ttl:
+            _, record = history.popleft()
+            self._forget(record)
+
+    def expire(self, now: Optional[float] = None) -> None:
+        """Drops the channels whose records have all expired"""
+        now = time.monotonic() if now is None else now
+        while self._channels:
+            channel_id, history = next(iter(self._channels.items()))
+            if now - history[-1][0] <= self.ttl:
+                break
+            del self._channels[channel_id]
+            for _, record in history:
+                self._forget(record)
+
+    def get(self, channel_id: int, index: int = 0) -> Optional[SnipeRecord]:
+        """The `index`th most recent record of the channel, starting from 0"""
+        history = self._channels.get(channel_id)
+        if history is None:
+            return None
+
+        self._expire(history, time.monotonic())
+        if not history:
+            del self._channels[channel_id]
+            return None
+        if not 0 <= index < len(history):
+            return None
+
+        return history[-1 - index][1]
+
+
+class MessageContentStore:
+    """
+    Records of the recent messages in snipe-enabled channels by message id, so that
+    deletes and edits of messages outside discord.py's message cache can be sniped
+    """
+
+    def __init__(self, max_bytes: int = 2 * 1024 * 1024):
+        self._records: LRUCache = LRUCache(max_bytes, getsizeof=lambda r: r.size)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    @property
+    def size(self) -> int:
+        return self._records.currsize
+
+    def add(self, message: discord.Message) -> None:
+        record = SnipeRecord.from_message(message)
+        # Records larger than the whole store aren't kept
+        if record.size <= self._records.maxsize:
+            self._records[message.id] = record
+
+    def get(self, message_id: int) -> Optional[SnipeRecord]:
+        return self._records.get(message_id)
+
+    def pop(self, message_id: int) -> Optional[SnipeRecord]:
+        return self._records.pop(message_id, None)
+
+    def update(self, message_id: int, record: SnipeRecord) -> None:
+        if message_id in self._records:
+            self._records[message_id] = record
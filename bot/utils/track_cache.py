@@ -0,0 +1,61 @@
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import wavelink
+from cachetools import TTLCache
+
+from bot.utils.metrics import LatencyRecorder
+from bot.utils.model_cache import ModelCache
+
+# Encoded track string and its info, which is all that's needed to rebuild a track
+CachedTrack = Tuple[str, dict]
+
+
+class TrackSearchCache:
+    """
+    Search results shared by every guild, keyed by the normalized query.
+    Identical searches made at the same time are coalesced into one request.
+    """
+
+    def __init__(self, maxsize: int = 500, ttl: float = 60 * 60):
+        self._cache = ModelCache(TTLCache(maxsize=maxsize, ttl=ttl))
+        self.search_latency = LatencyRecorder()
+
+    def __str__(self) -> str:
+        return f"{self.hit_rate:.0%} hits | {self.saved_latency:.1f}s saved"
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self._cache.hits + self._cache.misses
+        return self.saved_searches / lookups if lookups else 0.0
+
+    @property
+    def saved_searches(self) -> int:
+        # Misses which waited on another lookup's search didn't search either
+        return self._cache.hits + self._cache.misses - self._cache.loads
+
+    @property
+    def saved_latency(self) -> float:
+        """Estimated seconds of searching saved by the cache"""
+        return self.saved_searches * self.search_latency.average
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+    async def search(
+        self, query: str, searcher: Callable[[str], Awaitable]
+    ) -> Optional[List[wavelink.Track]]:
+        key = self.normalize(query)
+
+        async def load() -> List[CachedTrack]:
+            with self.search_latency.time():
+                tracks = await searcher(f"ytsearch:{key}")
+            return [(track.id, track.info) for track in tracks or ()]
+
+        cached_tracks = await self._cache.get_or_load(key, load)
+        if not cached_tracks:
+            # Failed/empty searches aren't kept, they may succeed on a retry
+            self._cache.pop(key)
+            return None
+
+        return [wavelink.Track(track_id, info) for track_id, info in cached_tracks]
@@ -5,6 +5,8 @@ class BotConfig(BaseSettings):
     token: str
     prefix: str
     developement_environment: bool
+    write_behind_registration: bool = True
+    max_messages: int = 250
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,27 @@
+from typing import List
+
+from pydantic import BaseModel, BaseSettings
+
+
+class LavalinkNode(BaseModel):
+    identifier: str
+    host: str
+    port: int = 2333
+    password: str = "youshallnotpass"
+    region: str = "india"
+
+    @property
+    def rest_uri(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+
+class LavalinkConfig(BaseSettings):
+    # Set as a JSON list, eg: `lavalink_nodes=[{"identifier": "MAIN", "host": "lavalink"}]`
+    nodes: List[LavalinkNode] = [LavalinkNode(identifier="MAIN", host="lavalink")]
+
+    class Config:
+        env_file = ".env"
+        env_prefix = "lavalink_"
+
+
+lavalink_config = LavalinkConfig()
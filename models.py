@@ -77,6 +77,7 @@ class AutoResponseModel(Model):
     class Meta:
         table = "autoresponses"
         table_description = "Represents the autoresponses for each GuildModel"
+        unique_together = (("guild", "trigger"),)
 
 
 class CommandModel(Model):
@@ -116,3 +117,5 @@ class LevelingUserModel(Model):
     class Meta:
         table = "UserLeveling"
         table_description = "Represents the Leveling data for each user in a guild!"
+        # Used for ranking users by xp within a guild
+        indexes = (("guild_id", "xp"),)